@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Snapchat's memories CDN plus a snap-mem.py benchmark (stdlib-only).
+
+The stand-in serves synthetic JPEG/MP4 payloads and captioned-memory ZIPs and
+can inject latency, 429s (with Retry-After), connection resets (before or
+mid-body) and ``Connection: close``. ``make_export`` writes a matching
+memories_history.json of any size.
+
+Examples:
+  python3 bench_snap_mem.py --items 500 --workers 1,4,16
+  python3 bench_snap_mem.py --items 2000 --latency-ms 30 --rate-429 0.02 --reset-rate 0.01
+  python3 bench_snap_mem.py --paths default,disk,inline -- --extract-queue 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import ModuleType
+
+DATE_FMT: str = "%Y-%m-%d %H:%M:%S UTC"
+JPEG_HEAD: bytes = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+MP4_HEAD: bytes = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+PNG_HEAD: bytes = b"\x89PNG\r\n\x1a\n"
+
+# Benchmark code paths: name -> extra snap-mem.py flags
+PATHS: dict[str, list[str]] = {
+  "default": [],
+  "disk": ["--mem-threshold", "0"],
+  "inline": ["--extract-workers", "0"],
+  "fifo": ["--order", "json"],
+  "dedupe": ["--dedupe", "link"],
+}
+
+
+def load_snap_mem() -> ModuleType:
+  """Import snap-mem.py (hyphenated file name) as a module."""
+  if "snap_mem" in sys.modules:
+    return sys.modules["snap_mem"]
+  spec = importlib.util.spec_from_file_location("snap_mem", Path(__file__).parent / "snap-mem.py")
+  mod = importlib.util.module_from_spec(spec)
+  sys.modules["snap_mem"] = mod
+  spec.loader.exec_module(mod)
+  return mod
+
+
+@dataclass(slots=True)
+class Faults:
+  latency_ms: float = 0.0
+  rate_429: float = 0.0
+  retry_after: int = 0
+  reset_rate: float = 0.0
+  midbody_reset_rate: float = 0.0
+  close_rate: float = 0.0
+  seed: int = 0
+
+
+def payload_for(path: str, *, image_kb: int = 200, video_kb: int = 4096) -> bytes:
+  """Deterministic synthetic body for /<kind>/<id>; kind is jpg, mp4 or zip."""
+  parts = path.strip("/").split("?", 1)[0].split("/")
+  kind, ident = (parts + ["", "0"])[:2]
+  rnd = random.Random(f"{kind}/{ident}")
+  if kind == "mp4":
+    return MP4_HEAD + rnd.randbytes(video_kb * 1024 - len(MP4_HEAD))
+  image = JPEG_HEAD + rnd.randbytes(image_kb * 1024 - len(JPEG_HEAD) - 2) + b"\xff\xd9"
+  if kind != "zip":
+    return image
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as z:
+    z.writestr("image.jpg", image)
+    z.writestr("caption.png", PNG_HEAD + rnd.randbytes(8 * 1024))
+    z.writestr("__MACOSX/._image.jpg", b"junk")
+  return buf.getvalue()
+
+
+class BacklogServer(ThreadingHTTPServer):
+  """ThreadingHTTPServer with a listen backlog large enough for a full worker sweep.
+
+  socketserver's default of 5 drops SYNs once more workers connect at once, and
+  each drop costs a 1 s retransmit that swamps any worker-count comparison.
+  """
+
+  request_queue_size = 128
+
+
+class StandIn:
+  """Threaded HTTP server on 127.0.0.1 standing in for the memories CDN."""
+
+  def __init__(self, faults: Faults | None = None, *, image_kb: int = 200, video_kb: int = 4096):
+    self.faults = faults or Faults()
+    self.image_kb, self.video_kb = image_kb, video_kb
+    self.requests = 0
+    self.injected: dict[str, int] = {}
+    self._lock = threading.Lock()
+    self._rnd = random.Random(self.faults.seed)
+    self._cache: dict[str, bytes] = {}
+    self._server = BacklogServer(("127.0.0.1", 0), self._handler())
+    self._server.daemon_threads = True
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+  @property
+  def base_url(self) -> str:
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def __enter__(self) -> StandIn:
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _roll(self, rate: float, name: str) -> bool:
+    with self._lock:
+      hit = rate > 0 and self._rnd.random() < rate
+      if hit:
+        self.injected[name] = self.injected.get(name, 0) + 1
+      return hit
+
+  def body(self, path: str) -> bytes:
+    with self._lock:
+      data = self._cache.get(path)
+    if data is None:
+      data = payload_for(path, image_kb=self.image_kb, video_kb=self.video_kb)
+      with self._lock:
+        self._cache[path] = data
+    return data
+
+  def _handler(self) -> type[BaseHTTPRequestHandler]:
+    stand_in = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+
+      def log_message(self, *args: object) -> None:
+        pass
+
+      def _reset(self) -> None:
+        self.close_connection = True
+        with contextlib.suppress(OSError):
+          self.connection.shutdown(socket.SHUT_RDWR)
+
+      def do_GET(self) -> None:
+        f = stand_in.faults
+        with stand_in._lock:
+          stand_in.requests += 1
+        if f.latency_ms:
+          time.sleep(f.latency_ms / 1000)
+        if stand_in._roll(f.reset_rate, "reset"):
+          self._reset()
+          return
+        if stand_in._roll(f.rate_429, "429"):
+          self.send_response(429)
+          self.send_header("Retry-After", str(f.retry_after))
+          self.send_header("Content-Length", "0")
+          self.end_headers()
+          return
+        data = stand_in.body(self.path)
+        status, start, end = 200, 0, len(data)
+        if (rng := self.headers.get("Range", "")).startswith("bytes="):
+          lo, _, hi = rng[6:].partition("-")
+          start, end = int(lo or 0), min(len(data), int(hi) + 1 if hi else len(data))
+          status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        if status == 206:
+          self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        if stand_in._roll(f.close_rate, "close"):
+          self.send_header("Connection", "close")
+          self.close_connection = True
+        self.end_headers()
+        if stand_in._roll(f.midbody_reset_rate, "midbody_reset"):
+          self.wfile.write(data[start : start + (end - start) // 2])
+          self._reset()
+          return
+        self.wfile.write(data[start:end])
+
+      do_HEAD = do_GET
+
+    return Handler
+
+
+def make_export(
+  path: Path,
+  base_url: str,
+  n: int,
+  *,
+  video_ratio: float = 0.2,
+  zip_ratio: float = 0.2,
+  seed: int = 0,
+) -> Path:
+  """Write a memories_history.json with n entries pointing at the stand-in."""
+  rnd = random.Random(seed)
+  t0 = 1_600_000_000
+  with path.open("w", encoding="utf-8") as f:
+    f.write('{"Saved Media": [')
+    for i in range(n):
+      roll = rnd.random()
+      kind = "mp4" if roll < video_ratio else "zip" if roll < video_ratio + zip_ratio else "jpg"
+      entry = {
+        "Date": time.strftime(DATE_FMT, time.gmtime(t0 + i * 61)),
+        "Media Type": "Video" if kind == "mp4" else "Image",
+        "Location": "Latitude, Longitude: 0.0, 0.0",
+        "Download Link": f"{base_url}/{kind}/{i}",
+        "Media Download Url": f"{base_url}/{kind}/{i}",
+      }
+      f.write(("," if i else "") + json.dumps(entry))
+    f.write("]}")
+  return path
+
+
+def run_once(json_path: Path, out_dir: Path, args: list[str]) -> tuple[int, float, dict]:
+  """Run snap-mem in-process; returns (exit code, seconds, stats report)."""
+  snap_mem = load_snap_mem()
+  stats_path = out_dir.parent / f"{out_dir.name}.stats.json"
+  argv = [
+    "--no-tui", "--json", str(json_path), "--out", str(out_dir), "--stats-json", str(stats_path),
+    "--preflight", "0", *args,
+  ]
+  sink = io.StringIO()
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+    rc = snap_mem.main(argv)
+  elapsed = time.perf_counter() - start
+  return rc, elapsed, json.loads(stats_path.read_text(encoding="utf-8"))
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+  p = argparse.ArgumentParser(description="Benchmark snap-mem.py against a local stand-in CDN.")
+  p.add_argument("--items", type=int, default=300, help="Entries in the generated export")
+  p.add_argument("--workers", default="1,4,16", help="Comma-separated worker counts to sweep")
+  p.add_argument("--paths", default="default", help=f"Code paths: {','.join(PATHS)}")
+  p.add_argument("--image-kb", type=int, default=200)
+  p.add_argument("--video-kb", type=int, default=4096)
+  p.add_argument("--video-ratio", type=float, default=0.2)
+  p.add_argument("--zip-ratio", type=float, default=0.2)
+  p.add_argument("--latency-ms", type=float, default=0.0, help="Added per-request latency")
+  p.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered 429")
+  p.add_argument("--reset-rate", type=float, default=0.0, help="Fraction reset before headers")
+  p.add_argument("--midbody-reset-rate", type=float, default=0.0)
+  p.add_argument("--close-rate", type=float, default=0.0, help="Fraction with Connection: close")
+  p.add_argument("--repeat", type=int, default=1, help="Runs per configuration (best is kept)")
+  p.add_argument("extra", nargs="*", help="Extra snap-mem.py flags (after --)")
+  return p.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+  ns = parse_args(argv)
+  unknown = [p for p in ns.paths.split(",") if p not in PATHS]
+  if unknown:
+    print(f"Unknown path(s): {', '.join(unknown)}", file=sys.stderr)
+    return 2
+  faults = Faults(
+    latency_ms=ns.latency_ms,
+    rate_429=ns.rate_429,
+    reset_rate=ns.reset_rate,
+    midbody_reset_rate=ns.midbody_reset_rate,
+    close_rate=ns.close_rate,
+  )
+  tmp = Path(tempfile.mkdtemp(prefix="snap-mem-bench-"))
+  try:
+    with StandIn(faults, image_kb=ns.image_kb, video_kb=ns.video_kb) as server:
+      export = make_export(
+        tmp / "memories_history.json",
+        server.base_url,
+        ns.items,
+        video_ratio=ns.video_ratio,
+        zip_ratio=ns.zip_ratio,
+      )
+      header = f"{'path':<8} {'workers':>7} {'items/s':>9} {'MB/s':>8} {'p90 ms':>7} {'retries':>7}"
+      print(f"{header} rc")
+      for path in ns.paths.split(","):
+        for workers in (int(w) for w in ns.workers.split(",")):
+          best: tuple[int, float, dict] | None = None
+          for i in range(ns.repeat):
+            out = tmp / f"{path}-{workers}-{i}"
+            flags = ["--workers", str(workers), "--min-workers", str(workers)]
+            flags += ["--max-workers", str(workers), "--retry-backoff", "0.05"]
+            result = run_once(export, out, [*flags, *PATHS[path], *ns.extra])
+            shutil.rmtree(out, ignore_errors=True)
+            if best is None or result[1] < best[1]:
+              best = result
+          rc, elapsed, stats = best
+          retries = sum(stats["retries"].values())
+          print(
+            f"{path:<8} {workers:>7} {stats['ok'] / elapsed:>9.1f} "
+            f"{stats['bytes'] / elapsed / 1e6:>8.1f} {stats['latency']['p90_ms'] or 0:>7g} "
+            f"{retries:>7} {rc}"
+          )
+      if server.injected:
+        print(f"Injected faults: {server.injected}")
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main(sys.argv[1:]))
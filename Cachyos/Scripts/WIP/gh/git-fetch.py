@@ -6,7 +6,7 @@ repositories without requiring git to be installed, using only the
 standard library.
 
 Usage:
-  fetch.py <github-or-gitlab-url> [output-dir] [--token TOKEN]
+  fetch.py <github-or-gitlab-url> [output-dir] [--token TOKEN] [--max-rate 2M]
 
 Environment Variables:
   GITHUB_TOKEN - Optional auth token for GitHub
@@ -18,8 +18,11 @@ import http.client
 import json
 import os
 import queue
+import re
 import sys
 import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 import urllib.parse
@@ -73,6 +76,39 @@ def parse_url(url: str) -> RepoSpec:
   raise ValueError(f"Unsupported platform: {u.netloc}")
 
 
+RATE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?(?:/s)?\s*$", re.I)
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_rate(spec: str) -> float:
+  """Parse '500K', '2M', '1.5MiB/s' etc. into bytes per second (0 = unlimited)."""
+  m = RATE_RE.match(spec)
+  if not m:
+    raise ValueError(f"invalid rate: {spec!r}")
+  return float(m.group(1)) * RATE_UNITS[m.group(2).lower()]
+
+
+class TokenBucket:
+  """Thread-safe token bucket shared by all download workers."""
+
+  def __init__(self, rate: float) -> None:
+    self.rate = rate
+    self._lock = threading.Lock()
+    self._tokens = rate
+    self._last = time.monotonic()
+
+  def consume(self, n: int) -> None:
+    if self.rate <= 0:
+      return
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate) - n
+      self._last = now
+      wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+    if wait > 0:
+      time.sleep(wait)
+
+
 _opener_cache: urllib.request.OpenerDirector | None = None
 
 
@@ -221,6 +257,7 @@ def process_single_download(
   local_path: Path,
   display_path: str,
   headers: dict[str, str],
+  limiter: TokenBucket | None = None,
 ) -> http.client.HTTPSConnection:
   """Process a single file download with retries."""
   retries = 3
@@ -241,6 +278,8 @@ def process_single_download(
             chunk = resp.read(65536)
             if not chunk:
               break
+            if limiter is not None:
+              limiter.consume(len(chunk))
             f.write(chunk)
         print(f"✓ {display_path}")
 
@@ -294,7 +333,9 @@ def process_single_download(
   return conn
 
 
-def download_worker(host: str, file_q: queue.Queue, headers: dict[str, str]) -> None:
+def download_worker(
+  host: str, file_q: queue.Queue, headers: dict[str, str], limiter: TokenBucket | None = None
+) -> None:
   """Worker thread: process files from queue using a persistent connection."""
   # Make a per-thread copy so we don't mutate a shared headers dict.
   headers = dict(headers)
@@ -314,7 +355,7 @@ def download_worker(host: str, file_q: queue.Queue, headers: dict[str, str]) ->
       try:
         url_path, local_path, display_path = item
         conn = process_single_download(
-          conn, host, url_path, local_path, display_path, headers
+          conn, host, url_path, local_path, display_path, headers, limiter
         )
       finally:
         file_q.task_done()
@@ -326,6 +367,7 @@ def process_downloads(
   files_to_download: list[tuple[str, Path, str]],
   headers: dict[str, str],
   host: str,
+  limiter: TokenBucket | None = None,
 ) -> None:
   """Execute concurrent downloads using a thread pool."""
   if not files_to_download:
@@ -345,7 +387,7 @@ def process_downloads(
 
   with ThreadPoolExecutor(max_workers=num_workers) as executor:
     futures = [
-      executor.submit(download_worker, host, file_q, dl_headers)
+      executor.submit(download_worker, host, file_q, dl_headers, limiter)
       for _ in range(num_workers)
     ]
     errors = []
@@ -359,7 +401,9 @@ def process_downloads(
       raise Exception(f"{len(errors)} download worker(s) failed.")
 
 
-def fetch_github(spec: RepoSpec, output: Path, token: str | None = None) -> None:
+def fetch_github(
+  spec: RepoSpec, output: Path, token: str | None = None, limiter: TokenBucket | None = None
+) -> None:
   """Download from GitHub using Contents/Trees API."""
   token = token or os.getenv("GITHUB_TOKEN", "")
   headers = {"Accept": "application/vnd.github.v3+json"}
@@ -424,10 +468,12 @@ def fetch_github(spec: RepoSpec, output: Path, token: str | None = None) -> None
       files_to_download.append((path_part, local_path, full_path))
 
   output.mkdir(parents=True, exist_ok=True)
-  process_downloads(files_to_download, headers, "raw.githubusercontent.com")
+  process_downloads(files_to_download, headers, "raw.githubusercontent.com", limiter)
 
 
-def fetch_gitlab(spec: RepoSpec, output: Path, token: str | None = None) -> None:
+def fetch_gitlab(
+  spec: RepoSpec, output: Path, token: str | None = None, limiter: TokenBucket | None = None
+) -> None:
   """Download from GitLab using Repository API."""
   token = token or os.getenv("GITLAB_TOKEN", "")
   headers = {}
@@ -483,7 +529,7 @@ def fetch_gitlab(spec: RepoSpec, output: Path, token: str | None = None) -> None
       path_part = f"/api/v4/projects/{project_id}/repository/files/{file_path_enc}/raw?ref={spec.branch}"
       files_to_download.append((path_part, local_path, item_path))
 
-  process_downloads(files_to_download, headers, "gitlab.com")
+  process_downloads(files_to_download, headers, "gitlab.com", limiter)
 
 
 def main() -> int:
@@ -491,18 +537,22 @@ def main() -> int:
   parser.add_argument("url", help="GitHub or GitLab URL")
   parser.add_argument("output_dir", nargs="?", default=".", help="Output directory")
   parser.add_argument("--token", help="Auth token (overrides env vars)")
+  parser.add_argument(
+    "--max-rate", default="0", help="Download cap across all workers, e.g. 2M (0 = unlimited)"
+  )
   parser.add_argument("--version", action="version", version="git-fetch.py 2.0.0")
 
   args = parser.parse_args()
 
   try:
     spec = parse_url(args.url)
+    limiter = TokenBucket(parse_rate(args.max_rate))
     output_path = Path(args.output_dir) / (Path(spec.path).name or spec.repo)
 
     if spec.platform == "github":
-      fetch_github(spec, output_path, args.token)
+      fetch_github(spec, output_path, args.token, limiter)
     else:
-      fetch_gitlab(spec, output_path, args.token)
+      fetch_gitlab(spec, output_path, args.token, limiter)
 
     print(f"\n✓ Downloaded to: {output_path}")
     return 0
@@ -3,141 +3,1082 @@ import logging
 import os
 import hashlib
 import argparse
+import fnmatch
+import json
+import mmap
+import queue
+import shutil
+import sqlite3
+import stat
+import struct
+import threading
+from array import array
+from functools import partial
 from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
+try:
+    import xxhash
+except ImportError:  # optional: pip install xxhash
+    xxhash = None
 
-def hash_file_partial(file_path, chunk_size=65536):
+try:
+    import fcntl
+except ImportError:  # not on Windows; reflink detection is then unavailable
+    fcntl = None
+
+# Name -> hash object factory. Dedupe only needs collision resistance, so any of
+# these will do; pick the fastest for the CPU (see bench_dup_hash.py). sha256
+# stays the default because SHA-NI makes it faster than blake2b on most x86.
+HASH_ALGORITHMS = {
+    "blake2b": hashlib.blake2b,
+    "sha1": hashlib.sha1,
+    "md5": hashlib.md5,
+    "sha256": hashlib.sha256,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh3"] = xxhash.xxh3_128
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+DEFAULT_HASH = "sha256"
+READ_SIZE = 1 << 20
+COMPARE_MAX_CHUNK = 1 << 22
+BACKENDS = ("auto", "threads", "processes")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+PIPELINE_BATCH = 64
+# linux/fiemap.h: _IOWR('f', 11, struct fiemap), 32-byte header, 56-byte extents
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQ16xI12x")
+FIEMAP_BATCH = 64
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+ACTIONS = ("report", "hardlink", "reflink", "move", "delete")
+KEEP_POLICIES = ("oldest", "shortest", "root")
+
+
+class HashCache:
+    """
+    Persistent sqlite cache of partial/full hashes, keyed by (st_dev, st_ino, size, mtime_ns).
+
+    Any change to a file's size or mtime gives it a new key, so stale hashes are
+    never returned. Lookups and stores happen in the parent process only.
+    """
+
+    KEY_MATCH = "dev=? AND ino=? AND size=? AND mtime_ns=? AND kind=?"
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                kind TEXT, digest TEXT, path TEXT,
+                PRIMARY KEY (dev, ino, size, mtime_ns, kind)
+            ) WITHOUT ROWID"""
+        )
+
+    def lookup(self, kind, keys):
+        """Returns {path: digest} for the paths in keys ({path: stat key}) already cached."""
+        found = {}
+        for path, key in keys.items():
+            row = self.conn.execute(
+                f"SELECT digest FROM hashes WHERE {self.KEY_MATCH}", (*key, kind)
+            ).fetchone()
+            if row:
+                found[path] = row[0]
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, kind, digests, keys):
+        rows = [
+            (*keys[p], kind, d, os.path.abspath(p)) for p, d in digests.items() if d and p in keys
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def prune(self, root, live_keys):
+        """Drops entries under root whose file vanished or changed since they were hashed."""
+        prefix = os.path.join(os.path.abspath(root), "")
+        rows = self.conn.execute(
+            "SELECT dev, ino, size, mtime_ns, kind FROM hashes WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+        stale = [row for row in rows if tuple(row[:4]) not in live_keys]
+        with self.conn:
+            self.conn.executemany(f"DELETE FROM hashes WHERE {self.KEY_MATCH}", stale)
+        return len(stale)
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_file_partial(file_path, chunk_size=65536, algorithm=DEFAULT_HASH):
     """
     Computes a partial hash of the file (first 64KB) to quickly filter non-duplicates.
     """
     try:
-        sha256_hash = hashlib.sha256()
+        h = HASH_ALGORITHMS[algorithm]()
         with open(file_path, "rb") as f:
             chunk = f.read(chunk_size)
-            sha256_hash.update(chunk)
-        return file_path, sha256_hash.hexdigest()
+            h.update(chunk)
+        return file_path, h.hexdigest()
     except (IOError, OSError) as e:
         print(f"Error partial hashing {file_path}: {e}")
         return file_path, None
 
 
-def hash_file(file_path):
+def hash_file_sample(file_path, samples=4, chunk_size=16384, algorithm=DEFAULT_HASH):
+    """
+    Hashes the tail and `samples` evenly spaced interior chunks with os.pread.
+    Photos from one camera often share their EXIF header and thumbnail, so this
+    separates most same-size files that the head hash cannot, without a full read.
+    """
+    try:
+        h = HASH_ALGORITHMS[algorithm]()
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            offsets = [size * i // (samples + 1) for i in range(1, samples + 1)]
+            offsets.append(max(0, size - chunk_size))
+            for offset in offsets:
+                h.update(os.pread(fd, chunk_size, offset))
+        finally:
+            os.close(fd)
+        return file_path, h.hexdigest()
+    except OSError as e:
+        print(f"Error sample hashing {file_path}: {e}")
+        return file_path, None
+
+
+def digest_fileobj(f, factory):
+    """
+    Hashes an open binary file. Regular files are mapped and passed to a single
+    update() call, so hashlib reads the whole file in C with the GIL released.
+    Empty or unmappable files (mmap refuses both) fall back to a readinto loop
+    over a reused READ_SIZE buffer.
+    """
+    h = factory()
     try:
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(65536), b""):
-                sha256_hash.update(byte_block)
-        return file_path, sha256_hash.hexdigest()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        mapped = None
+    if mapped is not None:
+        with mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(mapped)
+        return h
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    while n := f.readinto(buf):
+        h.update(view[:n])
+    return h
+
+
+def hash_file(file_path, algorithm=DEFAULT_HASH):
+    try:
+        with open(file_path, "rb", buffering=0) as f:
+            return file_path, digest_fileobj(f, HASH_ALGORITHMS[algorithm]).hexdigest()
     except Exception as e:
         print(f"Error hashing {file_path}: {e}")
         return file_path, None
 
 
-def group_files_by_size(starting_path):
-  """Groups files by size."""
-  size_dict = {}
-  stack = [starting_path]
-  while stack:
-    current_dir = stack.pop()
+def parse_extensions(spec):
+    """'jpg,.PNG' -> ('.jpg', '.png'); an empty spec or '*' matches every file."""
+    exts = tuple("." + e.strip().lower().lstrip(".") for e in spec.split(",") if e.strip())
+    return None if not exts or exts == (".*",) else exts
+
+
+def walk_files(
+    starting_path, walkers=8, extensions=IMAGE_EXTENSIONS, exclude=(), one_file_system=False
+):
+    """
+    Yields (path, stat) for every matching file under starting_path, as found.
+
+    `walkers` threads pull directories from a shared queue, so the per-directory
+    round trips of NFS/SMB mounts overlap instead of adding up. Only a few
+    directories' results wait for the consumer, so slow hashing holds the walk
+    back instead of letting the whole tree pile up. Names or paths matching an
+    `exclude` glob are skipped (directories are not entered), and with
+    one_file_system, directories on other devices are not entered.
+    Symlinks are never followed: a link is not a copy, and acting on it would
+    touch its target.
+    """
+    root_dev = os.stat(starting_path).st_dev if one_file_system else None
+    walkers = max(1, walkers)
+    dirs = queue.SimpleQueue()
+    found = queue.Queue(maxsize=walkers * 2)  # per-directory batches awaiting the consumer
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = 1  # directories queued or being scanned
+
+    def excluded(entry):
+        return any(
+            fnmatch.fnmatch(entry.name, pat) or fnmatch.fnmatch(entry.path, pat) for pat in exclude
+        )
+
+    def scan(current_dir):
+        nonlocal pending
+        files = []
+        with os.scandir(current_dir) as it:
+            for entry in it:
+                try:
+                    if exclude and excluded(entry):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if root_dev is not None and (
+                            entry.stat(follow_symlinks=False).st_dev != root_dev
+                        ):
+                            continue
+                        with lock:
+                            pending += 1
+                        dirs.put(entry.path)
+                    elif (
+                        extensions is None or entry.name.lower().endswith(extensions)
+                    ) and entry.is_file(follow_symlinks=False):
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError as e:
+                    logging.warning(f"Skipping {entry.path} due to OSError: {e}")
+        return files
+
+    def emit(item):
+        # Re-check stop while blocked, so a consumer that gave up cannot deadlock us
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        nonlocal pending
+        while (current_dir := dirs.get()) is not None:
+            try:
+                if not stop.is_set():
+                    emit(scan(current_dir))
+            except OSError as e:
+                logging.warning(f"Skipping directory {current_dir} due to OSError: {e}")
+            finally:
+                with lock:
+                    pending -= 1
+                    last = pending == 0
+                if last:
+                    emit(None)
+                    for _ in range(walkers):
+                        dirs.put(None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(walkers)]
+    dirs.put(starting_path)
+    for t in threads:
+        t.start()
     try:
-      with os.scandir(current_dir) as it:
-        for entry in it:
-          try:
-            if entry.is_dir(follow_symlinks=False):
-              stack.append(entry.path)
-            elif entry.name.lower().endswith((".jpg", ".jpeg", ".png", ".gif")) and entry.is_file():
-              file_size = entry.stat().st_size
-              if file_size in size_dict:
-                size_dict[file_size].append(entry.path)
-              else:
-                size_dict[file_size] = [entry.path]
-          except OSError as e:
-import logging
-    except OSError as e:
-      logging.warning(f"Skipping directory {current_dir} due to OSError: {e}")
-  return size_dict
+        while (batch := found.get()) is not None:
+            yield from batch
+    finally:
+        stop.set()  # consumer gave up early: let the walkers drain the queue quickly
+        for t in threads:
+            t.join()
 
 
-def find_duplicate_photos(starting_path, output_file_path):
-    # Step 1: Group by size
-    size_dict = group_files_by_size(starting_path)
+def make_pool(backend, jobs, algorithm):
+    """
+    Worker pool for hashing. hashlib releases the GIL while it reads and hashes,
+    so threads scale like processes without pickling every path and digest; auto
+    only picks processes for the xxhash algorithms. jobs is the I/O concurrency
+    (more than the CPU count helps on network shares, fewer on spinning disks).
+    """
+    if backend == "auto":
+        backend = "processes" if algorithm.startswith("xxh") else "threads"
+    if backend == "threads":
+        return ThreadPool(jobs)
+    if backend == "processes":
+        return Pool(processes=jobs)
+    raise ValueError(f"unknown backend: {backend!r}")
 
-    # Collect all candidates for partial hashing (any file that shares a size with another)
-    all_candidates = [
-        p for paths in size_dict.values() if len(paths) > 1 for p in paths
-    ]
 
-    if not all_candidates:
-        return
+def pool_map(pool, jobs, func, items):
+    """Results of func over items in completion order, in chunks sized to keep all jobs busy."""
+    chunksize = max(1, min(64, len(items) // (jobs * 4)))
+    return pool.imap_unordered(func, items, chunksize=chunksize)
 
-    final_duplicates = {}
 
-    with Pool(processes=cpu_count()) as pool:
-        # Step 2: Partial hashing
-        # Map: path -> partial_hash
-        partial_results = pool.map(hash_file_partial, all_candidates)
-        partial_hashes = dict(partial_results)
+def compare_group(paths, chunk_size=65536, max_chunk=COMPARE_MAX_CHUNK):
+    """
+    Reads the files of one same-size group in lockstep and splits it as soon as
+    contents diverge. Returns the sub-groups (2+ files) that are byte-identical:
+    differing files stop at the first mismatching chunk and confirmed duplicates
+    need no hash at all. Chunks start small and double, since most mismatches
+    show up early.
+    """
+    files = {}
+    try:
+        for p in paths:
+            try:
+                files[p] = open(p, "rb", buffering=0)
+            except OSError as e:
+                print(f"Error comparing {p}: {e}")
+        identical = []
+        pending = [list(files)] if len(files) > 1 else []
+        while pending:
+            still_equal = []
+            for group in pending:
+                parts = []  # [(chunk, paths)], compared with memcmp rather than hashed
+                for p in group:
+                    try:
+                        chunk = files[p].read(chunk_size)
+                    except OSError as e:
+                        print(f"Error comparing {p}: {e}")
+                        continue
+                    for data, members in parts:
+                        if data == chunk:
+                            members.append(p)
+                            break
+                    else:
+                        parts.append((chunk, [p]))
+                for data, members in parts:
+                    if len(members) > 1:
+                        (still_equal if data else identical).append(members)
+            pending = still_equal
+            chunk_size = min(chunk_size * 2, max_chunk)
+        return identical
+    finally:
+        for f in files.values():
+            f.close()
 
-        # Regroup by partial hash within size groups
-        full_hash_candidates = []
-        groups_to_check = []
 
-        for paths in size_dict.values():
-            if len(paths) < 2:
+def extent_map(file_path):
+    """
+    Physical extents of a file as ((logical, physical, length), ...) via the FIEMAP
+    ioctl, or None when they are unknown or not all marked shared. Two files with
+    the same map are reflinks of one another: their bytes are already stored once.
+    """
+    if fcntl is None:
+        return None
+    extents = []
+    start = 0
+    try:
+        with open(file_path, "rb") as f:
+            while True:
+                buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * FIEMAP_BATCH)
+                length = 2**64 - 1 - start
+                FIEMAP_HEADER.pack_into(buf, 0, start, length, FIEMAP_FLAG_SYNC, 0, FIEMAP_BATCH, 0)
+                fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+                mapped = FIEMAP_HEADER.unpack_from(buf)[3]
+                if not mapped:
+                    break
+                for n in range(mapped):
+                    logical, physical, length, flags = FIEMAP_EXTENT.unpack_from(
+                        buf, FIEMAP_HEADER.size + n * FIEMAP_EXTENT.size
+                    )
+                    if not flags & FIEMAP_EXTENT_SHARED:
+                        return None
+                    extents.append((logical, physical, length))
+                if flags & FIEMAP_EXTENT_LAST:
+                    break
+                start = logical + length
+    except OSError:
+        return None  # no FIEMAP on this filesystem (tmpfs, NFS, ...)
+    return tuple(extents) or None
+
+
+def split_reflinked(group):
+    """
+    Splits a duplicate group into (one path per distinct storage, [reflinked sets]).
+    Files already sharing every extent need no further deduplication.
+    """
+    by_extents = {}
+    distinct = []
+    for path in group:
+        extents = extent_map(path)
+        if extents is None:
+            distinct.append(path)
+        else:
+            by_extents.setdefault(extents, []).append(path)
+    shared = [paths for paths in by_extents.values() if len(paths) > 1]
+    distinct.extend(paths[0] for paths in by_extents.values())
+    return sorted(distinct), shared
+
+
+def split_groups(groups, hashes):
+    """Splits each group by digest, keeping only sub-groups that still have 2+ files."""
+    survivors = []
+    for group in groups:
+        by_hash = {}
+        for p in group:
+            h = hashes.get(p)
+            if h:
+                by_hash.setdefault(h, []).append(p)
+        survivors.extend(g for g in by_hash.values() if len(g) > 1)
+    return survivors
+
+
+class FileIndex:
+    """
+    Compact table of scanned files, addressed by integer id.
+
+    Directory paths are stored once, basenames are packed into one bytearray,
+    and size, inode, device and mtime live in typed arrays. A file costs about
+    60 bytes instead of a path string (and tuple) in every dict that mentions it.
+    """
+
+    def __init__(self):
+        self.dirs = []
+        self._dir_ids = {}
+        self.dir_of = array("I")
+        self.names = bytearray()
+        self.name_end = array("Q")
+        self.sizes = array("Q")
+        self.inodes = array("Q")
+        self.devs = array("Q")
+        self.mtimes = array("q")
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, path, st):
+        """Records one file; returns its id."""
+        directory, name = os.path.split(path)
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self._dir_ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        self.dir_of.append(dir_id)
+        self.names += os.fsencode(name)
+        self.name_end.append(len(self.names))
+        self.sizes.append(st.st_size)
+        self.inodes.append(st.st_ino)
+        self.devs.append(st.st_dev)
+        self.mtimes.append(st.st_mtime_ns)
+        return len(self.sizes) - 1
+
+    def path(self, file_id):
+        start = self.name_end[file_id - 1] if file_id else 0
+        name = os.fsdecode(bytes(self.names[start : self.name_end[file_id]]))
+        return os.path.join(self.dirs[self.dir_of[file_id]], name)
+
+    def key(self, file_id):
+        """HashCache key: (st_dev, st_ino, size, mtime_ns)."""
+        return (self.devs[file_id], self.inodes[file_id], self.sizes[file_id], self.mtimes[file_id])
+
+
+class HashPipeline:
+    """
+    Streams scanned files through the hashing stages while the walk goes on.
+
+    A size bucket is handed to the first stage as soon as it gains a second
+    member, and every later stage receives a sub-group as soon as two of its
+    files share all digests so far. Files are FileIndex ids throughout; paths
+    are only built for the batch being submitted. A stage remembers each file
+    it saw as one int -> int dict entry: a 64-bit key folding the size and the
+    digests so far, mapped to the file id while no other file matches it and to
+    PROMOTED once one does. Only the last stage keeps member lists (with raw
+    digest bytes), and only for groups that collide; the rest is counters. At
+    most `max_in_flight` batches wait in the pool. Results come back through a
+    queue and are handled (and cached) on the calling thread only.
+    """
+
+    PROMOTED = -1  # stands in for the member list of a key with two files or more
+
+    def __init__(self, pool, jobs, stages, index, cache=None, batch=PIPELINE_BATCH):
+        self.pool = pool
+        self.stages = stages  # [(name, func, cache kind)]
+        self.index = index
+        self.cache = cache
+        self.batch = batch
+        self.max_in_flight = jobs * 4
+        self.first_of_size = {}  # size -> only file id so far, or None once promoted
+        self.candidates = 0
+        self.size_groups = 0
+        self.repeated_sizes = set()  # filled by finish()
+        self.seen = [{} for _ in stages]  # stage -> {folded key: file id or PROMOTED}
+        self.counts = [[0, 0] for _ in stages]  # stage -> [files, groups] that collided
+        self.final = {}  # (folded key, last digest) -> [file ids], colliding groups only
+        self.entered = [False] * len(stages)
+        self.pending = [[] for _ in stages]  # stage -> [(key, file id)] not yet submitted
+        self.results = queue.SimpleQueue()
+        self.in_flight = 0
+
+    def add(self, file_id):
+        """Feeds one indexed file; may block briefly when the pool is saturated."""
+        size = self.index.sizes[file_id]
+        if size not in self.first_of_size:
+            self.first_of_size[size] = file_id
+            return
+        first = self.first_of_size[size]
+        if first is not None:
+            self.first_of_size[size] = None
+            self.size_groups += 1
+            self.candidates += 1
+            self._enqueue(0, size, first)
+        self.candidates += 1
+        self._enqueue(0, size, file_id)
+        while self.in_flight >= self.max_in_flight:
+            self._handle(self.results.get())
+
+    def finish(self):
+        """Drains every stage; returns [(digest, file ids)] for the groups that survived the last one."""
+        while True:
+            while True:
+                try:
+                    self._handle(self.results.get_nowait())
+                except queue.Empty:
+                    break
+            for stage in range(len(self.stages)):
+                self._flush(stage)
+            if not self.in_flight:
+                break
+            self._handle(self.results.get())
+        self.repeated_sizes = {size for size, first in self.first_of_size.items() if first is None}
+        self.first_of_size.clear()
+        self.seen = [{} for _ in self.stages]
+        return [(digest.hex(), sorted(ids)) for (_, digest), ids in self.final.items()]
+
+    def live_keys(self):
+        """Cache keys of every file that reached the first stage (call after finish)."""
+        index, sizes = self.index, self.repeated_sizes
+        return {index.key(i) for i in range(len(index)) if index.sizes[i] in sizes}
+
+    def report(self):
+        rows = [("size", self.candidates, self.size_groups)]
+        for (name, _, _), entered, (files, groups) in zip(self.stages, self.entered, self.counts):
+            if entered:
+                rows.append((name, files, groups))
+        return rows
+
+    def _enqueue(self, stage, key, file_id):
+        self.entered[stage] = True
+        self.pending[stage].append((key, file_id))
+        if len(self.pending[stage]) >= self.batch:
+            self._flush(stage)
+
+    def _flush(self, stage):
+        items, self.pending[stage] = self.pending[stage], []
+        if not items:
+            return
+        _, func, kind = self.stages[stage]
+        paths = [self.index.path(i) for _, i in items]
+        if self.cache is not None:
+            keys = {path: self.index.key(i) for path, (_, i) in zip(paths, items)}
+            hits = self.cache.lookup(kind, keys)
+            missed = []
+            for path, (key, i) in zip(paths, items):
+                if path in hits:
+                    self._advance(stage, key, i, hits[path])
+                else:
+                    missed.append((key, i))
+            if not missed:
+                return
+            items, paths = missed, [self.index.path(i) for _, i in missed]
+        self.in_flight += 1
+        self.pool.map_async(
+            func,
+            paths,
+            callback=lambda res: self.results.put((stage, items, res, None)),
+            error_callback=lambda exc: self.results.put((stage, items, None, exc)),
+        )
+
+    def _handle(self, result):
+        stage, items, hashed, exc = result
+        self.in_flight -= 1
+        if exc is not None:
+            raise exc
+        if self.cache is not None:
+            keys = {path: self.index.key(i) for (_, i), (path, _) in zip(items, hashed)}
+            self.cache.store(self.stages[stage][2], dict(hashed), keys)
+        for (key, file_id), (_, digest) in zip(items, hashed):
+            if digest:
+                self._advance(stage, key, file_id, digest)
+
+    def _advance(self, stage, key, file_id, digest):
+        last = stage + 1 == len(self.stages)
+        # A clash of folded keys only sends unrelated files one stage further;
+        # the last stage keys on the exact digest
+        key = (key, bytes.fromhex(digest)) if last else hash((key, digest))
+        seen = self.seen[stage]
+        first = seen.setdefault(key, file_id)
+        if first == file_id:
+            return
+        counts = self.counts[stage]
+        if first != self.PROMOTED:
+            seen[key] = self.PROMOTED
+            counts[0] += 1
+            counts[1] += 1
+            self._collided(stage, key, first, last)
+        counts[0] += 1
+        self._collided(stage, key, file_id, last)
+
+    def _collided(self, stage, key, file_id, last):
+        if last:
+            self.final.setdefault(key, []).append(file_id)
+        else:
+            self._enqueue(stage + 1, key, file_id)
+
+
+def is_under(path, root):
+    root = os.path.join(os.path.abspath(root), "")
+    return os.path.abspath(path).startswith(root)
+
+
+def choose_keeper(group, keep="oldest", prefer=()):
+    """
+    The file of a duplicate group that stays: the oldest (mtime), the shortest
+    path, or for "root" the oldest file under one of the preferred roots.
+    Symlinks are never kept; ValueError if the group has no regular file.
+    """
+    stats = {path: os.lstat(path) for path in group}
+    regular = [path for path in group if stat.S_ISREG(stats[path].st_mode)]
+    if not regular:
+        raise ValueError("no regular file to keep")
+
+    def rank(path):
+        mtime = stats[path].st_mtime_ns
+        if keep == "shortest":
+            return (len(path), mtime, path)
+        outside = keep == "root" and not any(is_under(path, r) for r in prefer)
+        return (outside, mtime, len(path), path)
+
+    return min(regular, key=rank)
+
+
+def replace_with(path, action, keeper):
+    """Atomically turns path into a hard link or reflink of keeper (temp file + rename)."""
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f".{name}.dup-{os.getpid()}-{threading.get_ident()}")
+    try:
+        if action == "hardlink":
+            os.link(keeper, tmp)
+        else:
+            if fcntl is None:
+                raise OSError("reflinks need fcntl (Linux)")
+            with open(keeper, "rb") as src, open(tmp, "xb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            # The clone is a new inode: carry over the replaced file's metadata
+            st = os.stat(path)
+            shutil.copystat(path, tmp)
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def quarantine_path(path, root, quarantine):
+    """Where move puts path: its location relative to root, under quarantine."""
+    rel = os.path.relpath(path, root) if is_under(path, root) else os.path.basename(path)
+    dest = os.path.join(quarantine, rel)
+    stem, ext = os.path.splitext(dest)
+    n = 1
+    while os.path.lexists(dest):
+        dest = f"{stem}.{n}{ext}"
+        n += 1
+    return dest
+
+
+def act_on_group(group, action, keep, prefer, root, quarantine, aliases=None):
+    """
+    Applies action to every file of one duplicate group except the keeper. The
+    group is compared byte-for-byte again first, so a file that changed since
+    it was hashed is left alone, and members are checked with lstat: symlinks
+    and other names for the keeper's inode are skipped, never removed. aliases
+    maps a member to the other names the scan found for its inode; they are
+    acted on too, so no name outside the keeper's inode keeps the bytes alive.
+    """
+    owner = {name: path for path in group for name in (path, *(aliases or {}).get(path, ()))}
+    try:
+        keeper = choose_keeper(list(owner), keep, prefer)
+        kept = os.lstat(keeper)
+    except (OSError, ValueError) as e:  # a member vanished since the scan, or only links remain
+        files = [{"path": p, "status": "error", "bytes": 0, "error": str(e)} for p in owner]
+        return {"keep": None, "files": files}
+    verified = next((g for g in compare_group(group) if owner[keeper] in g), [owner[keeper]])
+    moved = set()  # inodes already in the quarantine under another name
+    files = []
+    for path in sorted(owner):
+        if path == keeper:
+            continue
+        entry = {"path": path, "status": "changed", "bytes": 0}
+        files.append(entry)
+        try:
+            st = os.lstat(path)
+            inode = (st.st_dev, st.st_ino)
+            if not stat.S_ISREG(st.st_mode):
+                entry.update(status="skipped", reason="not a regular file")
+                continue
+            if inode == (kept.st_dev, kept.st_ino):
+                entry.update(status="skipped", reason="same file as keeper")
                 continue
+            if owner[path] not in verified:
+                continue
+            if action == "move":
+                dest = quarantine_path(path, root, quarantine)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.move(path, dest)
+                # The bytes still exist in the quarantine: nothing is reclaimed yet
+                entry.update(status="moved", to=dest, size=0 if inode in moved else st.st_size)
+                moved.add(inode)
+                continue
+            if action == "delete":
+                os.remove(path)
+                entry["status"] = "deleted"
+            else:
+                replace_with(path, action, keeper)
+                entry["status"] = f"{action}ed"
+            # Space only comes back once the last name for the inode goes; with
+            # a name outside the scanned tree it never does
+            entry["bytes"] = st.st_size if st.st_nlink == 1 else 0
+        except OSError as e:
+            entry.update(status="error", error=str(e))
+    return {"keep": keeper, "files": files}
 
-            # Group by partial hash
-            ph_groups = {}
-            for p in paths:
-                ph = partial_hashes.get(p)
-                if ph:
-                    if ph not in ph_groups:
-                        ph_groups[ph] = []
-                    ph_groups[ph].append(p)
-
-            # Identify groups that still have multiple candidates
-            for group in ph_groups.values():
-                if len(group) > 1:
-                    groups_to_check.append(group)
-                    full_hash_candidates.extend(group)
-
-        if full_hash_candidates:
-            # Remove duplicates from full_hash_candidates list to avoid redundant hashing?
-            # Actually `groups_to_check` might contain same file if I messed up? No.
-            # But `full_hash_candidates` is flat list.
-            # Files are unique in `all_candidates` (from `os.walk`).
-
-            # Step 3: Full hashing
-            full_results = pool.map(hash_file, full_hash_candidates)
-            full_hashes = dict(full_results)
-
-            # Step 4: Identify final duplicates
-            for group in groups_to_check:
-                fh_groups = {}
-                for p in group:
-                    fh = full_hashes.get(p)
-                    if fh:
-                        if fh not in fh_groups:
-                            fh_groups[fh] = []
-                        fh_groups[fh].append(p)
 
-                for fh, files in fh_groups.items():
-                    if len(files) > 1:
-                        final_duplicates[fh] = files
+def apply_action(
+    groups,
+    action,
+    root,
+    keep="oldest",
+    prefer=(),
+    quarantine=None,
+    jobs=None,
+    json_report=None,
+    aliases=None,
+):
+    """
+    Reclaims space from duplicate groups, one group per worker thread; groups
+    never share a file, so workers cannot step on each other. aliases maps a
+    group member to the other names of its inode (see act_on_group). Returns a summary
+    (also written to json_report when given) with the bytes reclaimed, or for
+    move, the bytes moved to the quarantine.
+    """
+    if action not in ACTIONS or action == "report":
+        raise ValueError(f"not an action: {action!r}")
+    if action == "move" and not quarantine:
+        raise ValueError("move needs a quarantine directory")
+    if keep not in KEEP_POLICIES:
+        raise ValueError(f"unknown keep policy: {keep!r}")
+    act = partial(
+        act_on_group,
+        action=action,
+        keep=keep,
+        prefer=prefer,
+        root=root,
+        quarantine=quarantine,
+        aliases=aliases,
+    )
+    with ThreadPool(jobs or cpu_count()) as pool:
+        results = pool.map(act, groups, chunksize=1)
+    files = [f for result in results for f in result["files"]]
+    summary = {
+        "action": action,
+        "keep": keep,
+        "groups": results,
+        "files_acted": sum(f["status"] not in ("changed", "skipped", "error") for f in files),
+        "files_changed": sum(f["status"] == "changed" for f in files),
+        "files_skipped": sum(f["status"] == "skipped" for f in files),
+        "errors": sum(f["status"] == "error" for f in files),
+        "reclaimed_bytes": sum(f["bytes"] for f in files),
+        "moved_bytes": sum(f.get("size", 0) for f in files),
+    }
+    if json_report:
+        with open(json_report, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+def find_duplicate_photos(
+    starting_path,
+    output_file_path,
+    cache=None,
+    algorithm=DEFAULT_HASH,
+    samples=4,
+    compare_max=3,
+    backend="auto",
+    jobs=None,
+    walk_options=None,
+    reflinks=False,
+    action_options=None,
+):
+    """
+    Writes groups of identical files to output_file_path. Candidates are narrowed
+    by size, head hash, sampled chunks (skipped when samples is 0) and finally
+    either a lockstep byte comparison (groups of up to compare_max files) or a
+    full hash. Hashing starts while the tree is still being scanned (see
+    HashPipeline). Hard links are collapsed to one entry per inode during the
+    scan and reported separately; with reflinks, duplicates that already share
+    their extents are reported separately too. action_options (see
+    apply_action) reclaim the space once the report is written. Returns
+    (report, summary): report is [(stage, surviving files, groups)] for each
+    stage run, then the hardlink (and reflink) counts and the action's acted-on
+    files; summary is apply_action's, or None when no action ran.
+    """
+    # Each stage reads more of the file than the one before; only files whose
+    # digests still collide within their group move on
+    stages = [("head", partial(hash_file_partial, algorithm=algorithm), f"partial:{algorithm}")]
+    if samples > 0:
+        sample = partial(hash_file_sample, samples=samples, algorithm=algorithm)
+        stages.append(("sample", sample, f"sample{samples}:{algorithm}"))
+    full_stage = ("full", partial(hash_file, algorithm=algorithm), f"full:{algorithm}")
+
+    # Small groups are compared directly, which reads only up to the first
+    # difference, so their final stage has to wait for the scan to finish. Without
+    # comparison (and always with a cache, where a stored full hash makes the next
+    # scan read nothing) the full hash streams like the other stages.
+    if cache is not None:
+        compare_max = 0
+    if compare_max <= 0:
+        stages.append(full_stage)
+
+    final_duplicates = []  # [(label, files)]
+    jobs = jobs or cpu_count()
+    with make_pool(backend, jobs, algorithm) as pool:
+        index = FileIndex()
+        pipeline = HashPipeline(pool, jobs, stages, index, cache)
+        # Every name of an inode shares its size, so inodes are only tracked once
+        # a size repeats, and only for hard-linked files (keyed dev << 64 | ino)
+        first_of_size = {}  # size -> first file id
+        linked = {}  # packed inode -> first file id, for st_nlink > 1
+        hardlinks = {}  # first file id -> [ids of every name for that inode]
+        for path, st in walk_files(starting_path, **(walk_options or {})):
+            file_id = index.add(path, st)
+            first = first_of_size.setdefault(st.st_size, file_id)
+            if first != file_id and st.st_nlink > 1:
+                linked.setdefault(index.devs[first] << 64 | index.inodes[first], first)
+                first = linked.setdefault(st.st_dev << 64 | st.st_ino, file_id)
+                if first != file_id:
+                    hardlinks.setdefault(first, [first]).append(file_id)
+                    continue  # same bytes as an entry already in the pipeline
+            pipeline.add(file_id)
+        first_of_size.clear()
+        linked.clear()
+
+        def distinct_inodes(ids):
+            # A single-link inode seen twice (a bind mount) only shows up here,
+            # in the same group as itself
+            firsts = {}
+            for file_id in ids:
+                first = firsts.setdefault((index.devs[file_id], index.inodes[file_id]), file_id)
+                if first != file_id:
+                    hardlinks.setdefault(first, [first]).append(file_id)
+            return sorted(map(index.path, firsts.values()))
+
+        survivors = []
+        for digest, ids in pipeline.finish():
+            group = distinct_inodes(ids)
+            if len(group) > 1:
+                survivors.append((digest, group))
+        report = pipeline.report()
+        if cache is not None:
+            # Only files sharing a size are ever cached, so only they need to stay
+            cache.prune(starting_path, pipeline.live_keys())
+
+        if not pipeline.candidates:
+            pass
+        elif compare_max <= 0:
+            # The full hash was the last stage, so its digest labels each group
+            final_duplicates.extend((f"Hash: {digest}", group) for digest, group in survivors)
+        else:
+            groups = [group for _, group in survivors]
+            compare = [group for group in groups if len(group) <= compare_max]
+            full = [group for group in groups if len(group) > compare_max]
+            if compare:
+                results = pool_map(pool, jobs, compare_group, compare)
+                identical = [sorted(group) for result in results for group in result]
+                report.append(("compare", sum(map(len, identical)), len(identical)))
+                final_duplicates.extend(("Identical bytes", group) for group in identical)
+            if full:
+                _, func, _ = full_stage
+                paths = [p for group in full for p in group]
+                hashes = dict(pool_map(pool, jobs, func, paths))
+                full = split_groups(full, hashes)
+                report.append(("full", sum(map(len, full)), len(full)))
+                final_duplicates.extend((f"Hash: {hashes[group[0]]}", group) for group in full)
+
+    link_groups = sorted(sorted(map(index.path, ids)) for ids in hardlinks.values())
+    report.append(("hardlinks", sum(map(len, link_groups)), len(link_groups)))
+    reflinked = []
+    if reflinks:
+        pending, final_duplicates = final_duplicates, []
+        for label, group in pending:
+            distinct, shared = split_reflinked(group)
+            reflinked.extend(shared)
+            if len(distinct) > 1:
+                final_duplicates.append((label, distinct))
+        report.append(("reflinks", sum(map(len, reflinked)), len(reflinked)))
 
     # Output results
     with open(output_file_path, "w") as f:
-        for key, value in final_duplicates.items():
-            f.write(f"Duplicate Photos (Hash: {key}):\n")
+        for key, value in sorted(final_duplicates, key=lambda item: item[1][0]):
+            f.write(f"Duplicate Photos ({key}):\n")
             for file_path in value:
                 f.write(f"{file_path}\n")
             f.write("\n")
+        for title, groups in (("Hard Links", link_groups), ("Already Reflinked", reflinked)):
+            for value in sorted(groups):
+                f.write(f"{title} (not duplicates, stored once):\n")
+                for file_path in value:
+                    f.write(f"{file_path}\n")
+                f.write("\n")
+
+    options = dict(action_options or {})
+    summary = None
+    if options.get("action", "report") != "report":
+        options.setdefault("jobs", jobs)
+        groups = [group for _, group in final_duplicates]
+        aliases = {index.path(ids[0]): list(map(index.path, ids[1:])) for ids in hardlinks.values()}
+        summary = apply_action(groups, root=starting_path, aliases=aliases, **options)
+        report.append((summary["action"], summary["files_acted"], len(groups)))
+    return report, summary
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find duplicate photos.")
     parser.add_argument("directory", help="Directory to scan")
     parser.add_argument("output", help="Output file for duplicates")
+    parser.add_argument(
+        "--cache",
+        metavar="DB",
+        help="sqlite hash cache reused across runs (e.g. ~/.cache/dup-hashes.sqlite)",
+    )
+    parser.add_argument(
+        "--hash",
+        choices=sorted(HASH_ALGORITHMS),
+        default=DEFAULT_HASH,
+        help=f"Hash algorithm (default: {DEFAULT_HASH}; xxh3/xxh64 need the xxhash package)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=4,
+        help="Interior chunks compared (with the tail) before full hashing; 0 skips the stage",
+    )
+    parser.add_argument(
+        "--compare-max",
+        type=int,
+        default=3,
+        help="Groups up to this size are compared byte-by-byte instead of hashed "
+        "(0: always hash; ignored with --cache)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="auto",
+        help="Hash in threads or processes (auto: threads unless hashing with xxhash)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Files read concurrently (default: CPU count)",
+    )
+    parser.add_argument(
+        "--walkers",
+        type=int,
+        default=8,
+        help="Threads listing directories (raise for NFS/SMB mounts)",
+    )
+    parser.add_argument(
+        "--one-file-system",
+        action="store_true",
+        help="Do not descend into directories on other filesystems",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Skip files/directories whose name or path matches (repeatable)",
+    )
+    parser.add_argument(
+        "--ext",
+        default=",".join(e.lstrip(".") for e in IMAGE_EXTENSIONS),
+        help="Comma-separated extensions to consider ('*' for all files)",
+    )
+    parser.add_argument(
+        "--reflinks",
+        action="store_true",
+        help="Use FIEMAP to report duplicates that already share extents separately",
+    )
+    parser.add_argument(
+        "--action",
+        choices=ACTIONS,
+        default="report",
+        help="What to do with all but one file of each group (re-verified byte-for-byte first)",
+    )
+    parser.add_argument(
+        "--keep",
+        choices=KEEP_POLICIES,
+        default="oldest",
+        help="Which file of a group stays: oldest mtime, shortest path, or under --prefer-root",
+    )
+    parser.add_argument(
+        "--prefer-root",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="Directory whose copies are kept with --keep root (repeatable)",
+    )
+    parser.add_argument("--quarantine", metavar="DIR", help="Destination for --action move")
+    parser.add_argument(
+        "--json-report",
+        metavar="FILE",
+        help="JSON record of every action and the bytes reclaimed (default: OUTPUT.json)",
+    )
     args = parser.parse_args()
+    if args.action == "move" and not args.quarantine:
+        parser.error("--action move needs --quarantine DIR")
+    if args.keep == "root" and not args.prefer_root:
+        parser.error("--keep root needs --prefer-root DIR")
 
-    find_duplicate_photos(args.directory, args.output)
+    cache = HashCache(os.path.expanduser(args.cache)) if args.cache else None
+    try:
+        report, summary = find_duplicate_photos(
+            args.directory,
+            args.output,
+            cache=cache,
+            algorithm=args.hash,
+            samples=args.samples,
+            compare_max=args.compare_max,
+            backend=args.backend,
+            jobs=args.jobs,
+            walk_options={
+                "walkers": args.walkers,
+                "extensions": parse_extensions(args.ext),
+                "exclude": args.exclude,
+                "one_file_system": args.one_file_system,
+            },
+            reflinks=args.reflinks,
+            action_options={
+                "action": args.action,
+                "keep": args.keep,
+                "prefer": args.prefer_root,
+                "quarantine": args.quarantine,
+                "json_report": args.json_report or f"{args.output}.json",
+            },
+        )
+        for stage, files, groups in report:
+            print(f"{stage:>9}: {files} files in {groups} groups")
+        if summary is not None and summary["action"] == "move":
+            print(f"Moved {summary['moved_bytes'] / 1024**2:.1f} MiB to {args.quarantine}")
+        elif summary is not None:
+            print(f"Reclaimed {summary['reclaimed_bytes'] / 1024**2:.1f} MiB")
+    finally:
+        if cache is not None:
+            print(f"Hash cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
@@ -2,8 +2,28 @@
 import os
 import shutil
 import tempfile
+import time
 import unittest
-from Dup import find_duplicate_photos
+from unittest import mock
+import hashlib
+import json
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from Dup import (
+    HASH_ALGORITHMS,
+    FileIndex,
+    HashCache,
+    HashPipeline,
+    apply_action,
+    choose_keeper,
+    compare_group,
+    find_duplicate_photos,
+    hash_file,
+    hash_file_partial,
+    parse_extensions,
+    split_reflinked,
+    walk_files,
+)
 
 
 class TestDup(unittest.TestCase):
@@ -69,6 +89,366 @@ class TestDup(unittest.TestCase):
         self.assertNotIn("partial_collision1.jpg", output)
         self.assertNotIn("partial_collision2.jpg", output)
 
+    def test_hash_cache_rescan(self):
+        content = b"duplicate_content" * 100
+        self.create_file("dup1.jpg", content)
+        self.create_file("dup2.jpg", content)
+        self.create_file("other.jpg", b"X" * len(content))
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        db = os.path.join(cache_dir, "hashes.sqlite")
+
+        cache = HashCache(db)
+        find_duplicate_photos(self.test_dir, self.output_file, cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 7))  # 3 head + 2 sample + 2 full
+        cache.close()
+
+        # Unchanged tree: everything comes from the cache
+        cache = HashCache(db)
+        find_duplicate_photos(self.test_dir, self.output_file, cache)
+        self.assertEqual((cache.hits, cache.misses), (7, 0))
+        cache.close()
+
+        # A rewritten file gets a new key and is rehashed; its stale rows are pruned
+        os.remove(os.path.join(self.test_dir, "dup2.jpg"))
+        self.create_file("dup2.jpg", b"Y" * len(content))
+        cache = HashCache(db)
+        find_duplicate_photos(self.test_dir, self.output_file, cache)
+        self.assertEqual(cache.misses, 1)
+        rows = cache.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        self.assertEqual(rows, 5)  # old dup2 rows gone; dup1 sample/full still valid
+        cache.close()
+        with open(self.output_file) as f:
+            self.assertNotIn("dup1.jpg", f.read())
+
+    def test_hash_algorithms(self):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        path = self.create_file("big.jpg", content)
+        for name in ("blake2b", "sha1", "md5", "sha256"):
+            self.assertEqual(hash_file(path, name), (path, hashlib.new(name, content).hexdigest()))
+        for name in HASH_ALGORITHMS:
+            self.assertIsNotNone(hash_file(path, name)[1])
+        # Empty files cannot be mapped; neither can some filesystems' files
+        empty = self.create_file("empty.jpg", b"")
+        self.assertEqual(hash_file(empty)[1], hashlib.sha256(b"").hexdigest())
+        with mock.patch("Dup.mmap.mmap", side_effect=OSError("no mmap")):
+            self.assertEqual(hash_file(path, "sha1")[1], hashlib.sha1(content).hexdigest())
+
+        self.create_file("copy.jpg", content)
+        find_duplicate_photos(self.test_dir, self.output_file, algorithm="md5", compare_max=0)
+        with open(self.output_file) as f:
+            self.assertIn(hashlib.md5(content).hexdigest(), f.read())
+
+    def test_sample_stage_before_full_hash(self):
+        header = b"H" * 65536  # shared EXIF header/thumbnail
+        body = os.urandom(200 * 1024)
+        self.create_file("a.jpg", header + body)
+        self.create_file("b.jpg", header + body)
+        self.create_file("c.jpg", header + body[:1000] + b"Z" + body[1001:])  # differs mid-file
+        self.create_file("d.jpg", header + body[:30000] + b"Q" + body[30001:])  # between samples
+
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file, compare_max=0)
+        self.assertEqual(
+            report,
+            [("size", 4, 1), ("head", 4, 1), ("sample", 3, 1), ("full", 2, 1), ("hardlinks", 0, 0)],
+        )
+        with open(self.output_file) as f:
+            output = f.read()
+        self.assertIn("a.jpg", output)
+        self.assertNotIn("c.jpg", output)
+        self.assertNotIn("d.jpg", output)
+
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file, samples=0, compare_max=0)
+        self.assertEqual([stage for stage, _, _ in report], ["size", "head", "full", "hardlinks"])
+
+    def test_compare_small_groups(self):
+        body = os.urandom(300 * 1024)
+        a = self.create_file("a.jpg", body)
+        b = self.create_file("b.jpg", body)
+        c = self.create_file("c.jpg", body[:-1] + b"!")
+        d = self.create_file("d.jpg", body)
+        self.assertEqual(compare_group([a, b, c]), [[a, b]])
+        self.assertEqual(compare_group([a, c]), [])
+        self.assertEqual(compare_group([a, b, c, d], chunk_size=1000), [[a, b, d]])
+
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file, samples=0)
+        self.assertEqual(report[-2], ("full", 3, 1))  # 4 files > compare_max: hashed
+        os.remove(d)
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file, samples=0)
+        self.assertEqual(report[-2], ("compare", 2, 1))
+        with open(self.output_file) as f:
+            output = f.read()
+        self.assertIn("Identical bytes", output)
+        self.assertIn("a.jpg", output)
+        self.assertNotIn("c.jpg", output)
+
+    def test_backends_agree(self):
+        for i in range(6):
+            self.create_file(f"pair{i}a.jpg", bytes([i]) * 5000)
+            self.create_file(f"pair{i}b.jpg", bytes([i]) * 5000)
+        self.create_file("odd.jpg", b"\xff" * 5000)
+        outputs = set()
+        for backend in ("threads", "processes", "auto"):
+            report, _ = find_duplicate_photos(
+                self.test_dir, self.output_file, backend=backend, jobs=3, compare_max=0
+            )
+            self.assertEqual(report[-2], ("full", 12, 6))
+            with open(self.output_file) as f:
+                outputs.add("".join(sorted(f.read().splitlines(True))))
+        self.assertEqual(len(outputs), 1)
+
+    def test_parallel_walker(self):
+        expected = set()
+        for d in range(5):
+            for sub in range(4):
+                os.makedirs(os.path.join(self.test_dir, f"d{d}", f"s{sub}"))
+                for name in ("a.jpg", "b.PNG", "c.txt"):
+                    path = self.create_file(os.path.join(f"d{d}", f"s{sub}", name), b"x")
+                    if not name.endswith(".txt"):
+                        expected.add(path)
+        os.makedirs(os.path.join(self.test_dir, "cache"))
+        self.create_file(os.path.join("cache", "skip.jpg"), b"x")
+
+        for walkers in (1, 8):
+            found = {p for p, _ in walk_files(self.test_dir, walkers=walkers, exclude=["cache"])}
+            self.assertEqual(found, expected)
+        pngs = {p for p, _ in walk_files(self.test_dir, extensions=parse_extensions("png"))}
+        self.assertEqual(len(pngs), 20)
+        self.assertEqual(len(list(walk_files(self.test_dir, extensions=None))), 61)
+        self.assertEqual(len(list(walk_files(self.test_dir, one_file_system=True))), 41)
+        self.assertEqual(parse_extensions(" JPG, .png "), (".jpg", ".png"))
+        self.assertIsNone(parse_extensions("*"))
+
+    def test_walker_waits_for_slow_consumer(self):
+        for d in range(60):
+            os.makedirs(os.path.join(self.test_dir, f"d{d:02d}"))
+            self.create_file(os.path.join(f"d{d:02d}", "a.jpg"), b"x")
+        scanned = []
+        real_scandir = os.scandir
+
+        def counting_scandir(path):
+            scanned.append(path)
+            return real_scandir(path)
+
+        with mock.patch("Dup.os.scandir", side_effect=counting_scandir):
+            files = walk_files(self.test_dir, walkers=2)
+            next(files)
+            time.sleep(0.3)
+            # Root plus a handful of batches queued or blocked, not all 60 directories
+            self.assertLess(len(scanned), 15)
+            started = time.monotonic()
+            files.close()  # giving up early must not hang the blocked walkers
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_pipeline_streams_groups(self):
+        paths = {}
+        for name, content in (("a", b"1" * 10), ("b", b"1" * 10), ("c", b"2" * 10),
+                              ("d", b"3" * 20), ("e", b"1" * 10), ("f", b"4" * 30)):
+            paths[name] = self.create_file(f"{name}.jpg", content)
+        stages = [
+            ("head", hash_file_partial, "partial"),
+            ("full", partial(hash_file, algorithm="md5"), "full"),
+        ]
+        with ThreadPool(2) as pool:
+            index = FileIndex()
+            pipeline = HashPipeline(pool, 2, stages, index, batch=1)
+            for name in "abcdef":
+                pipeline.add(index.add(paths[name], os.stat(paths[name])))
+                if name == "b":
+                    # a+b share a size, so head hashing is already under way mid-scan
+                    self.assertTrue(pipeline.entered[0])
+                    self.assertFalse(pipeline.entered[1])
+            survivors = pipeline.finish()
+        self.assertEqual(survivors, [(hashlib.md5(b"1" * 10).hexdigest(), [0, 1, 4])])
+        self.assertEqual(pipeline.report(), [("size", 4, 1), ("head", 3, 1), ("full", 3, 1)])
+        # Singletons are counted, not kept, and nothing per file outlives finish()
+        self.assertEqual(pipeline.first_of_size, {})
+        self.assertEqual(pipeline.seen, [{}, {}])
+        self.assertEqual(pipeline.repeated_sizes, {10})
+        self.assertEqual(pipeline.live_keys(), {index.key(i) for i in (0, 1, 2, 4)})
+
+    def test_file_index(self):
+        index = FileIndex()
+        paths = [os.path.join(self.test_dir, d, n) for d in ("x", "y") for n in ("a.jpg", "é.png")]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"abc")
+        ids = [index.add(p, os.stat(p)) for p in paths]
+        self.assertEqual(ids, [0, 1, 2, 3])
+        self.assertEqual([index.path(i) for i in ids], paths)
+        self.assertEqual(len(index.dirs), 2)
+        st = os.stat(paths[3])
+        self.assertEqual(index.key(3), (st.st_dev, st.st_ino, 3, st.st_mtime_ns))
+
+    def test_hardlinks_collapsed(self):
+        content = b"duplicate_content" * 100
+        a = self.create_file("a.jpg", content)
+        b = self.create_file("b.jpg", content)
+        os.link(a, os.path.join(self.test_dir, "a_link.jpg"))
+        os.link(a, os.path.join(self.test_dir, "a_link2.jpg"))
+
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file)
+        self.assertEqual(report[0], ("size", 2, 1))  # one entry per inode
+        self.assertEqual(report[-1], ("hardlinks", 3, 1))
+        with open(self.output_file) as f:
+            output = f.read()
+        dups, links = output.split("Hard Links")
+        self.assertEqual(dups.count(".jpg"), 2)
+        self.assertIn(b, dups)
+        self.assertIn("a_link.jpg", links)
+        self.assertIn("a_link2.jpg", links)
+
+    def test_symlinks_and_aliases_not_duplicates(self):
+        content = b"duplicate_content" * 100
+        real = self.create_file("IMG_0001_original_long_name.jpg", content)
+        os.symlink(real, os.path.join(self.test_dir, "a.jpg"))
+        self.assertEqual([p for p, _ in walk_files(self.test_dir)], [real])
+
+        # The same single-link file reached twice, as through a bind mount
+        alias = os.path.join(self.test_dir, "a.jpg")
+        st = os.stat(real)
+        self.assertEqual(st.st_nlink, 1)
+        with mock.patch("Dup.walk_files", return_value=[(real, st), (alias, st)]):
+            report, _ = find_duplicate_photos(self.test_dir, self.output_file)
+        # It is only recognised once hashing puts it in a group with itself
+        self.assertEqual(report[-1], ("hardlinks", 2, 1))
+        with open(self.output_file) as f:
+            self.assertNotIn("Duplicate Photos", f.read())
+
+    def test_reflinked_groups_split(self):
+        extents = {"a": ((0, 4096, 8192),), "b": ((0, 4096, 8192),), "c": None, "d": None}
+        with mock.patch("Dup.extent_map", side_effect=extents.get):
+            self.assertEqual(split_reflinked(["a", "b", "c"]), (["a", "c"], [["a", "b"]]))
+            self.assertEqual(split_reflinked(["c", "d"]), (["c", "d"], []))
+
+    def _dup_tree(self):
+        content = os.urandom(20000)
+        paths = []
+        for i, rel in enumerate(("a/one.jpg", "b/two.jpg", "b/deeper/three.jpg")):
+            os.makedirs(os.path.join(self.test_dir, os.path.dirname(rel)), exist_ok=True)
+            path = self.create_file(rel, content)
+            os.utime(path, ns=(1_000_000_000 * (i + 1),) * 2)
+            paths.append(path)
+        return content, paths
+
+    def test_keep_policies(self):
+        _, (one, two, three) = self._dup_tree()
+        group = [three, two, one]
+        self.assertEqual(choose_keeper(group, "oldest"), one)
+        self.assertEqual(choose_keeper(group, "shortest"), one)  # ties with two.jpg; older
+        prefer = [os.path.join(self.test_dir, "b")]
+        self.assertEqual(choose_keeper(group, "root", prefer), two)
+
+    def test_action_hardlink_reports_reclaimed_bytes(self):
+        content, (one, two, three) = self._dup_tree()
+        json_path = os.path.join(self.test_dir, "actions.json")
+        report, summary = find_duplicate_photos(
+            self.test_dir,
+            self.output_file,
+            action_options={"action": "hardlink", "json_report": json_path},
+        )
+        self.assertEqual(report[-1], ("hardlink", 2, 1))
+        self.assertEqual(os.stat(one).st_ino, os.stat(two).st_ino)
+        self.assertEqual(os.stat(one).st_ino, os.stat(three).st_ino)
+        with open(three, "rb") as f:
+            self.assertEqual(f.read(), content)
+        with open(json_path) as f:
+            self.assertEqual(json.load(f), summary)
+        self.assertEqual(summary["reclaimed_bytes"], 2 * len(content))
+        self.assertEqual(summary["groups"][0]["keep"], one)
+
+        # A second run sees one inode with three names: nothing left to do
+        report, _ = find_duplicate_photos(self.test_dir, self.output_file)
+        self.assertEqual(report[-1], ("hardlinks", 3, 1))
+
+    def test_action_move_and_delete_reverify(self):
+        content, (one, two, three) = self._dup_tree()
+        quarantine = os.path.join(self.test_dir, "q")
+        with open(three, "r+b") as f:  # changes after the scan found the group
+            f.write(b"!")
+        summary = apply_action([[one, two, three]], "move", self.test_dir, quarantine=quarantine)
+        statuses = {f["path"]: f["status"] for f in summary["groups"][0]["files"]}
+        self.assertEqual(statuses, {two: "moved", three: "changed"})
+        self.assertTrue(os.path.exists(os.path.join(quarantine, "b", "two.jpg")))
+        self.assertFalse(os.path.exists(two))
+        self.assertEqual(summary["files_changed"], 1)
+        self.assertEqual((summary["reclaimed_bytes"], summary["moved_bytes"]), (0, len(content)))
+
+        summary = apply_action([[one, three]], "delete", self.test_dir)
+        self.assertEqual(summary["files_acted"], 0)
+        self.assertTrue(os.path.exists(three))
+        with self.assertRaises(ValueError):
+            apply_action([[one, three]], "move", self.test_dir)
+
+
+    def test_action_never_removes_symlink_targets(self):
+        content = os.urandom(100000)
+        real = self.create_file("IMG_0001_original_long_name.jpg", content)
+        link = os.path.join(self.test_dir, "a.jpg")
+        os.symlink(real, link)
+        for action in ("delete", "move", "hardlink"):
+            # Even when handed a group with a symlink, the real file stays and the link is kept as is
+            summary = apply_action(
+                [[real, link]], action, self.test_dir, keep="shortest",
+                quarantine=os.path.join(self.test_dir, "q"),
+            )
+            self.assertEqual(summary["groups"][0]["keep"], real)
+            self.assertEqual(summary["files_skipped"], 1)
+            self.assertEqual((summary["files_acted"], summary["reclaimed_bytes"]), (0, 0))
+            self.assertTrue(os.path.islink(link))
+            with open(link, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+        # Two names for one inode: the other name is not removed as a "duplicate"
+        alias = os.path.join(self.test_dir, "b.jpg")
+        os.link(real, alias)
+        summary = apply_action([[real, alias]], "delete", self.test_dir)
+        self.assertEqual(summary["groups"][0]["files"][0]["reason"], "same file as keeper")
+        self.assertTrue(os.path.exists(alias))
+
+        # Scanning the tree with the link in it finds nothing to act on
+        report, summary = find_duplicate_photos(
+            self.test_dir, self.output_file, action_options={"action": "delete"}
+        )
+        self.assertEqual(report[-1], ("delete", 0, 0))
+        self.assertTrue(os.path.exists(real))
+
+    def test_action_reaches_every_name_of_an_inode(self):
+        content = os.urandom(50000)
+        orig = self.create_file("orig.jpg", content)
+        copy = self.create_file("copy.jpg", content)
+        os.utime(orig, ns=(10**18, 10**18))
+        os.link(copy, os.path.join(self.test_dir, "copy_alias.jpg"))
+
+        # One run converges: the copy's bytes do not survive under its other name
+        _, summary = find_duplicate_photos(
+            self.test_dir, self.output_file, action_options={"action": "hardlink"}
+        )
+        self.assertEqual(summary["files_acted"], 2)
+        self.assertEqual(summary["reclaimed_bytes"], len(content))
+        names = [os.path.join(self.test_dir, n) for n in os.listdir(self.test_dir)]
+        self.assertEqual({os.stat(p).st_ino for p in names if p.endswith(".jpg")},
+                         {os.stat(orig).st_ino})
+
+        # The keeper may be an alias; the other inode still goes
+        x0 = self.create_file("x0.jpg", content)
+        link = os.path.join(self.test_dir, "l.jpg")
+        os.link(x0, link)
+        y = self.create_file("y.jpg", content)
+        summary = apply_action(
+            [[x0, y]], "delete", self.test_dir, keep="shortest", aliases={x0: [link]}
+        )
+        self.assertEqual(summary["groups"][0]["keep"], link)
+        self.assertEqual(summary["reclaimed_bytes"], len(content))
+        self.assertTrue(os.path.exists(x0))
+        self.assertFalse(os.path.exists(y))
+
+        # A name the scan never saw keeps the bytes alive: acted on, nothing reclaimed
+        y = self.create_file("y.jpg", content)
+        os.link(y, os.path.join(self.test_dir, "elsewhere.bin"))
+        summary = apply_action([[link, y]], "delete", self.test_dir, keep="shortest")
+        self.assertEqual((summary["files_acted"], summary["reclaimed_bytes"]), (1, 0))
 
 if __name__ == "__main__":
     unittest.main()
@@ -3,15 +3,25 @@
 Snapchat memories_history.json downloader (stdlib-only).
 
 Features:
-  - CLI flags + optional curses TUI for selecting JSON + output dir
-  - Atomic streaming downloads (.part -> final)
+  - CLI flags + optional curses TUI for selecting JSON + output dir (cached, / to filter)
+  - Streaming JSON parse: downloads start while the export is still being read
+  - Several exports (files or directories) merged into one deduplicated stream
+  - Atomic streaming downloads (.part -> final); small payloads stay in memory
   - ZIP extraction for captioned memories (caption.png, image.jpg, video.mp4)
-  - Collision-safe filenames (timestamp-based)
-  - Parallel downloads with retry/backoff
+  - Collision-safe filenames (timestamp-based), optionally sharded by year/month
+  - Optional content-hash dedupe: repeated media become hardlinks or are skipped
+  - Parallel downloads with adaptive (AIMD) concurrency; failed items are re-queued
+    with jittered, Retry-After aware delays and a circuit breaker pauses on 5xx storms
+  - Separate bounded extraction pool so network workers never wait on disk
+  - Longest-first scheduling from media-type priors or optional size probes
+  - Global/per-connection bandwidth caps with an optional time-of-day schedule
   - Optional filtering (video/image), dry-run, skip-existing
+  - --stats-json run metrics: throughput timeline, TTFB/latency histograms, retries
+  - Signed-URL expiry pre-flight; permanent 4xx errors fail fast without retries
 
 Examples:
   python3 -O snap-mem.py --json /path/memories_history.json --out /path/out
+  python3 -O snap-mem.py --json exports/ old/memories_history.json --out /path/out
   python3 -O snap-mem.py   # interactive TUI if TTY
 """
 
@@ -19,25 +29,59 @@ from __future__ import annotations
 
 import argparse
 import curses
+import hashlib
+import heapq
+import http.client
+import io
+import itertools
 import json
 import os
+import random
 import re
 import shutil
 import sys
 import threading
 import time
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from typing import Any, BinaryIO, TextIO
 from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, urlsplit
 from urllib.request import OpenerDirector, Request, build_opener
 
 DATE_FMT: str = "%Y-%m-%d %H:%M:%S UTC"
-JSON_NAME_RE: re.Pattern[str] = re.compile(r"memories_history\.json$", re.I)
+# Browsers rename re-downloads: "memories_history (1).json", "memories_history-2.json"
+JSON_NAME_RE: re.Pattern[str] = re.compile(r"memories_history.*\.json$", re.I)
 CHUNK_SIZE: int = 1048576
 MACOS_JUNK_RE: re.Pattern[str] = re.compile(r"^\._")
+RATE_RE: re.Pattern[str] = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?(?:/s)?\s*$", re.I)
+RATE_UNITS: dict[str, int] = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+JSON_READ_SIZE: int = 65536
+VIDEO_SIZE_PRIOR: int = 8 * 1024**2
+IMAGE_SIZE_PRIOR: int = 512 * 1024
+DEDUPE_INDEX_NAME: str = ".snap-mem-hashes.tsv"
+LATENCY_BUCKETS_MS: tuple[float, ...] = (
+  5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, float("inf")
+)
+# Truncated bodies raise http.client.IncompleteRead, which is not an OSError
+NET_ERRORS: tuple[type[Exception], ...] = (
+  HTTPError, URLError, TimeoutError, OSError, http.client.HTTPException
+)
+SIGNATURE_PARAMS: frozenset[str] = frozenset(
+  {"sig", "signature", "expires", "ts", "key-pair-id", "policy", "token"}
+)
+SIGNED_DATE_FMT: str = "%Y%m%dT%H%M%SZ"
+RETRY_MAX_DELAY: float = 300.0
+RETRYABLE_4XX: frozenset[int] = frozenset({408, 425, 429})
+DEAD_LINK_CODES: frozenset[int] = frozenset({401, 403, 404, 410})
+CONTENT_RANGE_RE: re.Pattern[str] = re.compile(r"bytes\s+\d+-\d+/(\d+)", re.I)
+JSON_WS: str = " \t\n\r"
+TUI_BATCH: int = 512  # scandir entries read between TUI redraws
 
 
 @dataclass(frozen=True, slots=True)
@@ -47,6 +91,14 @@ class Item:
   is_video: bool
 
 
+@dataclass(slots=True)
+class Task:
+  item: Item
+  base: str
+  size: int = 0  # expected bytes: probed, else a prior from the media type
+  attempt: int = 0  # failed downloads so far
+
+
 def die(msg: str, code: int = 1) -> None:
   print(msg, file=sys.stderr)
   raise SystemExit(code)
@@ -57,7 +109,14 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     prog="snap-mem.py",
     description="Download Snapchat Saved Media from memories_history.json (stdlib only).",
   )
-  p.add_argument("--json", dest="json_path", default="", help="Path to memories_history.json")
+  p.add_argument(
+    "--json",
+    dest="json_paths",
+    nargs="+",
+    action="extend",
+    default=[],
+    help="memories_history.json file(s) or directories of exports; entries are merged",
+  )
   p.add_argument("--out", dest="out_dir", default="", help="Output directory for downloads")
   p.add_argument(
     "--type",
@@ -67,50 +126,326 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     help="Filter media type",
   )
   p.add_argument("--dry-run", action="store_true", help="List what would be downloaded")
+  p.add_argument(
+    "--expired",
+    default="skip",
+    choices=["skip", "abort", "download"],
+    help="What to do with URLs whose signature has expired (default: skip)",
+  )
+  p.add_argument(
+    "--preflight",
+    type=int,
+    default=3,
+    help="Probe this many URLs of each export before starting; abort if all are rejected "
+    "(0 = off)",
+  )
   p.add_argument("--skip-existing", action="store_true", help="Skip if target file already exists")
   p.add_argument("--timeout", type=float, default=30.0, help="HTTP timeout seconds")
   p.add_argument("--retries", type=int, default=3, help="Retries per file")
   p.add_argument("--retry-backoff", type=float, default=1.0, help="Base backoff seconds")
+  p.add_argument(
+    "--breaker-threshold",
+    type=int,
+    default=10,
+    help="Consecutive 5xx responses that pause all downloads (0: off)",
+  )
+  p.add_argument(
+    "--breaker-cooldown",
+    type=float,
+    default=30.0,
+    help="Seconds the pool pauses when the breaker trips (doubles while 5xx persist)",
+  )
   p.add_argument(
     "--user-agent",
     default="Mozilla/5.0 (SnapchatMemoryDownloader; +stdlib)",
     help="User-Agent header",
   )
+  p.add_argument(
+    "--max-rate",
+    default="0",
+    help="Global download cap shared by all workers, e.g. 2M or 500K (bytes/s, 0 = unlimited)",
+  )
+  p.add_argument(
+    "--max-rate-per-conn", default="0", help="Per-connection download cap (bytes/s, 0 = unlimited)"
+  )
+  p.add_argument(
+    "--rate-schedule",
+    default="",
+    help="Local-time overrides for --max-rate, e.g. '08:00-23:00=2M,23:00-08:00=0'",
+  )
+  p.add_argument(
+    "--extract-workers",
+    type=int,
+    default=2,
+    help="Threads extracting/storing finished downloads (0 = inline in network workers)",
+  )
+  p.add_argument(
+    "--extract-queue",
+    type=int,
+    default=8,
+    help="Finished downloads allowed to wait for extraction before downloading pauses",
+  )
+  p.add_argument(
+    "--write-buffer",
+    default="4M",
+    help="Coalesce received data into writes of this size (0 = write every read)",
+  )
+  p.add_argument(
+    "--order",
+    default="size",
+    choices=["size", "json"],
+    help="Start the largest expected transfers first, or keep JSON order",
+  )
+  p.add_argument(
+    "--probe",
+    action="store_true",
+    help="Probe real sizes with a 1-byte range GET before scheduling",
+  )
+  p.add_argument("--probe-workers", type=int, default=8, help="Parallel size probes")
+  p.add_argument("--large-size", default="32M", help="Transfers at least this big count as large")
+  p.add_argument(
+    "--max-large", type=int, default=0, help="Max large transfers at once (0 = no cap)"
+  )
+  p.add_argument(
+    "--lookahead",
+    type=int,
+    default=4096,
+    help="Parsed tasks buffered for scheduling before parsing waits",
+  )
+  p.add_argument(
+    "--mem-threshold",
+    default="16M",
+    help="Keep downloads up to this size in memory instead of a temp file (0 = always disk)",
+  )
+  p.add_argument(
+    "--layout",
+    default="flat",
+    choices=["flat", "year", "year/month"],
+    help="Output layout: one directory, or subdirectories by capture date",
+  )
+  p.add_argument(
+    "--dedupe",
+    default="off",
+    choices=["off", "link", "skip"],
+    help="Store repeated media once: hardlink later copies, or skip them entirely",
+  )
+  p.add_argument(
+    "--stats-json", default="", help="Write run metrics (throughput, latencies, retries) here"
+  )
   p.add_argument("--no-tui", action="store_true", help="Disable TUI prompts; require flags")
   p.add_argument(
-    "--workers", type=int, default=4, help="Number of parallel download workers (default: 4)"
+    "--workers",
+    type=int,
+    default=4,
+    help="Initial parallel download workers; adapts between the bounds below (default: 4)",
+  )
+  p.add_argument(
+    "--min-workers", type=int, default=1, help="Lower bound for adaptive concurrency (default: 1)"
+  )
+  p.add_argument(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="Upper bound for adaptive concurrency (default: 16, or --workers if higher; "
+    "set all three equal for a fixed pool)",
+  )
+  p.add_argument(
+    "--adapt-interval",
+    type=float,
+    default=5.0,
+    help="Seconds between throughput samples for adaptive concurrency",
   )
   return p.parse_args(argv)
 
 
-def load_items(json_path: Path, media_type: str) -> list[Item]:
+class JsonStream:
+  """Incremental reader for walking a JSON document one value at a time."""
+
+  __slots__ = ("_f", "_buf", "_pos", "_eof", "_read_size", "_dec")
+
+  def __init__(self, f: TextIO, read_size: int = JSON_READ_SIZE) -> None:
+    self._f = f
+    self._buf = ""
+    self._pos = 0
+    self._eof = False
+    self._read_size = read_size
+    self._dec = json.JSONDecoder()
+
+  def _fill(self, size: int) -> bool:
+    if self._eof:
+      return False
+    chunk = self._f.read(size)
+    if not chunk:
+      self._eof = True
+      return False
+    self._buf = self._buf[self._pos :] + chunk
+    self._pos = 0
+    return True
+
+  def peek(self) -> str:
+    """Skip whitespace and return the next character ('' at EOF)."""
+    while True:
+      n = len(self._buf)
+      while self._pos < n and self._buf[self._pos] in JSON_WS:
+        self._pos += 1
+      if self._pos < n:
+        return self._buf[self._pos]
+      if not self._fill(self._read_size):
+        return ""
+
+  def expect(self, ch: str) -> None:
+    got = self.peek()
+    if got != ch:
+      raise ValueError(f"expected {ch!r} at offset {self._pos}, got {got or 'EOF'!r}")
+    self._pos += 1
+
+  def value(self) -> Any:
+    """Decode the next complete value, reading more input until it parses."""
+    self.peek()
+    size = self._read_size
+    while True:
+      try:
+        obj, end = self._dec.raw_decode(self._buf, self._pos)
+      except json.JSONDecodeError:
+        if not self._fill(size):
+          raise
+        size *= 2  # Large values: grow reads so re-decoding stays linear-ish
+        continue
+      # A number cut at the buffer edge decodes "successfully"; make sure it ended
+      if end == len(self._buf) and self._fill(size):
+        continue
+      self._pos = end
+      return obj
+
+
+def iter_saved_media(f: TextIO) -> Iterator[Any]:
+  """Yield the raw entries of the top-level "Saved Media" list without loading the file."""
+  s = JsonStream(f)
+  s.expect("{")
+  if s.peek() == "}":
+    return
+  while True:
+    key = s.value()
+    s.expect(":")
+    if key == "Saved Media":
+      if s.peek() != "[":
+        die('JSON missing "Saved Media" list')
+      s.expect("[")
+      if s.peek() == "]":
+        return
+      while True:
+        yield s.value()
+        if s.peek() == "]":
+          return
+        s.expect(",")
+    s.value()
+    if s.peek() == "}":
+      return
+    s.expect(",")
+
+
+def iter_items(json_path: Path, media_type: str) -> Iterator[Item]:
+  """Stream filtered Items from memories_history.json as they are parsed."""
+  want_video, want_image = media_type == "video", media_type == "image"
   try:
     with json_path.open("r", encoding="utf-8") as f:
       try:
-        data = json.load(f)
-      except json.JSONDecodeError as e:
+        for obj in iter_saved_media(f):
+          if not isinstance(obj, dict):
+            continue
+          mt = str(obj.get("Media Type", "")).lower()
+          is_video = mt == "video"
+          if (want_video and not is_video) or (want_image and is_video):
+            continue
+          date_str, url = obj.get("Date"), obj.get("Media Download Url")
+          if not isinstance(date_str, str) or not date_str:
+            continue
+          if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+            continue
+          yield Item(date_str=date_str, url=url, is_video=is_video)
+      except ValueError as e:
         die(f"Invalid JSON: {json_path}\n{e}")
   except OSError as e:
     die(f"Failed to read JSON: {json_path}\n{e}")
-  media_items = data.get("Saved Media", [])
-  if not isinstance(media_items, list):
-    die('JSON missing "Saved Media" list')
-  out: list[Item] = []
-  want_video, want_image = media_type == "video", media_type == "image"
-  for obj in media_items:
-    if not isinstance(obj, dict):
-      continue
-    mt = str(obj.get("Media Type", "")).lower()
-    is_video = mt == "video"
-    if (want_video and not is_video) or (want_image and is_video):
-      continue
-    date_str, url = obj.get("Date"), obj.get("Media Download Url")
-    if not isinstance(date_str, str) or not date_str:
-      continue
-    if not isinstance(url, str) or not url.startswith(("http://", "https://")):
-      continue
-    out.append(Item(date_str=date_str, url=url, is_video=is_video))
-  return out
+
+
+def find_exports(paths: list[Path]) -> list[Path]:
+  """Expand directories to the memories_history*.json files below them (sorted, unique)."""
+  found: list[Path] = []
+  for path in paths:
+    if path.is_dir():
+      matches = (p for p in path.rglob("*") if JSON_NAME_RE.search(p.name) and p.is_file())
+      found.extend(sorted(matches))
+    elif path.is_file():
+      found.append(path)
+    else:
+      die(f"JSON does not exist: {path}")
+  unique = list(dict.fromkeys(p.resolve() for p in found))
+  if not unique:
+    die(f"No memories_history*.json found under: {', '.join(map(str, paths))}")
+  return unique
+
+
+def media_key(item: Item) -> tuple[str, ...]:
+  """Identity of a memory that survives re-exports (signatures and expiry differ)."""
+  parts = urlsplit(item.url)
+  query = parse_qsl(parts.query)
+  for name, value in query:
+    if name == "mid":
+      return ("mid", value, item.date_str)
+  stable = sorted(
+    (k, v)
+    for k, v in query
+    if k.lower() not in SIGNATURE_PARAMS and not k.lower().startswith(("x-amz-", "x-goog-"))
+  )
+  return ("url", parts.netloc, parts.path, repr(stable), item.date_str)
+
+
+def link_rank(item: Item, export_mtime: float, now: float) -> tuple[int, float, float]:
+  """Preference among copies of one memory (higher wins).
+
+  Unexpired signatures beat unknown expiry, which beats expired ones; a later
+  expiry, then the newer export file (by mtime), breaks ties.
+  """
+  exp = url_expiry(item.url)
+  if exp is None:
+    return (1, 0.0, export_mtime)
+  return (2 if exp >= now else 0, exp, export_mtime)
+
+
+class MergedItems:
+  """Iterate several exports as one stream, keeping one copy of each memory.
+
+  A memory found in several exports is taken from the one whose link is
+  freshest (see link_rank), so an old export's stale signature never hides a
+  newer export's valid one. That needs a first pass over every export to
+  rank the copies; a single export streams straight through.
+  """
+
+  def __init__(self, json_paths: list[Path], media_type: str) -> None:
+    self.json_paths = json_paths
+    self.media_type = media_type
+    self.duplicates = 0
+
+  def __iter__(self) -> Iterator[Item]:
+    if len(self.json_paths) == 1:
+      yield from iter_items(self.json_paths[0], self.media_type)
+      return
+    now = time.time()
+    best: dict[tuple[str, ...], tuple[tuple[int, float, float], int, int]] = {}
+    for export, path in enumerate(self.json_paths):
+      mtime = path.stat().st_mtime
+      for n, item in enumerate(iter_items(path, self.media_type)):
+        key = media_key(item)
+        rank = link_rank(item, mtime, now)
+        if key not in best or rank > best[key][0]:
+          best[key] = (rank, export, n)
+    for export, path in enumerate(self.json_paths):
+      for n, item in enumerate(iter_items(path, self.media_type)):
+        if best[media_key(item)][1:] != (export, n):
+          self.duplicates += 1
+          continue
+        yield item
 
 
 def build_base_name(date_str: str) -> str:
@@ -129,61 +464,714 @@ def make_unique_name(base: str, suffix: str, existing: set[str], lock: threading
     return name
 
 
+def parse_rate(spec: str) -> float:
+  """Parse '500K', '2M', '1.5MiB/s' etc. into bytes per second (0 = unlimited)."""
+  m = RATE_RE.match(spec)
+  if not m:
+    raise ValueError(f"invalid rate: {spec!r}")
+  return float(m.group(1)) * RATE_UNITS[m.group(2).lower()]
+
+
+def parse_size(spec: str) -> int:
+  """Parse '8M', '512K' etc. into bytes."""
+  m = RATE_RE.match(spec)
+  if not m:
+    raise ValueError(f"invalid size: {spec!r}")
+  return int(float(m.group(1)) * RATE_UNITS[m.group(2).lower()])
+
+
+def parse_rate_schedule(spec: str) -> list[tuple[int, int, float]]:
+  """Parse 'HH:MM-HH:MM=RATE,...' into (start_min, end_min, bytes/s) windows."""
+  windows: list[tuple[int, int, float]] = []
+  for part in filter(None, (p.strip() for p in spec.split(","))):
+    span, sep, rate = part.partition("=")
+    start, dash, end = span.partition("-")
+    if not sep or not dash:
+      raise ValueError(f"invalid schedule entry: {part!r}")
+    try:
+      t0 = datetime.strptime(start.strip(), "%H:%M")
+      t1 = datetime.strptime(end.strip(), "%H:%M")
+    except ValueError:
+      raise ValueError(f"invalid schedule time: {part!r}") from None
+    windows.append((t0.hour * 60 + t0.minute, t1.hour * 60 + t1.minute, parse_rate(rate)))
+  return windows
+
+
+class TokenBucket:
+  """Thread-safe token bucket; consumers go into debt and sleep it off outside the lock."""
+
+  def __init__(
+    self,
+    rate: float,
+    *,
+    burst: float | None = None,
+    schedule: list[tuple[int, int, float]] | None = None,
+  ) -> None:
+    self.rate = rate
+    self.schedule = schedule or []
+    self._burst = burst
+    self._lock = threading.Lock()
+    self._tokens = burst if burst is not None else rate
+    self._last = time.monotonic()
+
+  def current_rate(self) -> float:
+    if self.schedule:
+      now = datetime.now()
+      minute = now.hour * 60 + now.minute
+      for start, end, rate in self.schedule:
+        inside = start <= minute < end if start < end else (minute >= start or minute < end)
+        if inside:
+          return rate
+    return self.rate
+
+  def consume(self, n: int) -> None:
+    rate = self.current_rate()
+    if rate <= 0:
+      return
+    burst = self._burst if self._burst is not None else rate
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(burst, self._tokens + (now - self._last) * rate) - n
+      self._last = now
+      wait = -self._tokens / rate if self._tokens < 0 else 0.0
+    if wait > 0:
+      time.sleep(wait)
+
+
+class Histogram:
+  """Fixed-bucket latency histogram in milliseconds (not thread-safe; RunStats locks)."""
+
+  __slots__ = ("counts", "total", "n", "max")
+
+  def __init__(self) -> None:
+    self.counts = [0] * len(LATENCY_BUCKETS_MS)
+    self.total = 0.0
+    self.n = 0
+    self.max = 0.0
+
+  def add(self, ms: float) -> None:
+    for i, upper in enumerate(LATENCY_BUCKETS_MS):
+      if ms <= upper:
+        self.counts[i] += 1
+        break
+    self.total += ms
+    self.n += 1
+    self.max = max(self.max, ms)
+
+  def quantile(self, q: float) -> float | None:
+    """Upper bound of the bucket holding the q-quantile."""
+    if not self.n:
+      return None
+    seen, rank = 0, q * self.n
+    for upper, count in zip(LATENCY_BUCKETS_MS, self.counts):
+      seen += count
+      if seen >= rank:
+        return self.max if upper == float("inf") else upper
+    return self.max
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      "count": self.n,
+      "mean_ms": round(self.total / self.n, 2) if self.n else None,
+      "max_ms": round(self.max, 2),
+      "p50_ms": self.quantile(0.5),
+      "p90_ms": self.quantile(0.9),
+      "p99_ms": self.quantile(0.99),
+      "buckets_ms": {
+        ("inf" if upper == float("inf") else f"{upper:g}"): count
+        for upper, count in zip(LATENCY_BUCKETS_MS, self.counts)
+      },
+    }
+
+
+def error_class(exc: BaseException) -> str:
+  if isinstance(exc, HTTPError):
+    return f"HTTP {exc.code}"
+  if isinstance(exc, URLError) and isinstance(exc.reason, BaseException):
+    return type(exc.reason).__name__
+  return type(exc).__name__
+
+
+class RunStats:
+  """Per-run counters shared by worker threads; one short lock hold per event."""
+
+  def __init__(self) -> None:
+    self._lock = threading.Lock()
+    self.start = time.monotonic()
+    self.requests = 0
+    self.bytes = 0
+    self.timeline: dict[int, int] = {}
+    self.ttfb = Histogram()
+    self.latency = Histogram()
+    self.extract = Histogram()
+    self.retries: dict[str, int] = {}
+    self.failures: dict[str, int] = {}
+
+  def second(self) -> int:
+    """Whole seconds since the run started (the throughput_mb_s index)."""
+    return int(time.monotonic() - self.start)
+
+  def record_transfer(self, second: int, nbytes: int) -> None:
+    """Bytes received during one second of the run, as the body arrives."""
+    if not nbytes:
+      return
+    with self._lock:
+      self.timeline[second] = self.timeline.get(second, 0) + nbytes
+
+  def record_response(self, ttfb: float, elapsed: float, nbytes: int) -> None:
+    with self._lock:
+      self.requests += 1
+      self.bytes += nbytes
+      self.ttfb.add(ttfb * 1000)
+      self.latency.add(elapsed * 1000)
+
+  def record_error(self, exc: BaseException, *, retried: bool) -> None:
+    counter = self.retries if retried else self.failures
+    key = error_class(exc)
+    with self._lock:
+      counter[key] = counter.get(key, 0) + 1
+
+  def record_extract(self, elapsed: float) -> None:
+    with self._lock:
+      self.extract.add(elapsed * 1000)
+
+  def to_dict(self, **extra: Any) -> dict[str, Any]:
+    with self._lock:
+      elapsed = time.monotonic() - self.start
+      last = max(self.timeline, default=-1)
+      return {
+        **extra,
+        "elapsed_s": round(elapsed, 3),
+        "requests": self.requests,
+        "bytes": self.bytes,
+        "mean_mb_s": round(self.bytes / elapsed / 1e6, 3) if elapsed else None,
+        "throughput_mb_s": [
+          round(self.timeline.get(sec, 0) / 1e6, 3) for sec in range(last + 1)
+        ],
+        "ttfb": self.ttfb.to_dict(),
+        "latency": self.latency.to_dict(),
+        "extract": self.extract.to_dict(),
+        "retries": dict(self.retries),
+        "failures": dict(self.failures),
+      }
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+  """Seconds requested by a Retry-After header (delta or HTTP date), if any."""
+  if not isinstance(exc, HTTPError) or exc.headers is None:
+    return None
+  value = exc.headers.get("Retry-After")
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    when = parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  if when.tzinfo is None:
+    when = when.replace(tzinfo=timezone.utc)
+  return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def url_expiry(url: str) -> float | None:
+  """Expiry (epoch seconds) encoded in a signed URL's query string, if recognisable.
+
+  Handles CloudFront/S3v2-style ``Expires=<epoch>`` and the SigV4/GCS
+  ``X-Amz-Date``+``X-Amz-Expires`` / ``X-Goog-Date``+``X-Goog-Expires`` pairs.
+  """
+  q = {k.lower(): v for k, v in parse_qsl(urlsplit(url).query)}
+  try:
+    if (v := q.get("expires")) is not None:
+      return float(v)
+    for vendor in ("amz", "goog"):
+      date, ttl = q.get(f"x-{vendor}-date"), q.get(f"x-{vendor}-expires")
+      if date and ttl:
+        signed = datetime.strptime(date, SIGNED_DATE_FMT).replace(tzinfo=timezone.utc)
+        return signed.timestamp() + float(ttl)
+  except ValueError:
+    return None
+  return None
+
+
+def retry_delay(attempt: int, backoff: float, exc: BaseException) -> float:
+  """Full-jitter delay before retry number attempt+1, never shorter than Retry-After."""
+  cap = min(RETRY_MAX_DELAY, backoff * (2**attempt))
+  return max(random.uniform(0, cap), retry_after_seconds(exc) or 0.0)
+
+
+def is_permanent(exc: BaseException) -> bool:
+  """Client errors that retrying will not fix (expired signature, missing object...)."""
+  return isinstance(exc, HTTPError) and 400 <= exc.code < 500 and exc.code not in RETRYABLE_4XX
+
+
+def is_throttle(exc: BaseException) -> bool:
+  """True for congestion signals from the CDN: 429, 5xx and timeouts."""
+  if isinstance(exc, HTTPError):
+    return exc.code == 429 or exc.code >= 500
+  if isinstance(exc, URLError):
+    return isinstance(exc.reason, TimeoutError)
+  return isinstance(exc, TimeoutError)
+
+
+class AimdController:
+  """Gate on concurrent downloads using additive increase / multiplicative decrease.
+
+  Every ``interval`` seconds the aggregate throughput of finished downloads is
+  compared with the previous sample; an improvement raises the limit by one.
+  Throttling signals halve it (at most once per interval) and Retry-After
+  pauses new acquisitions.
+  """
+
+  def __init__(
+    self, *, initial: int, lo: int, hi: int, interval: float = 5.0, log: TextIO | None = None
+  ) -> None:
+    self.lo, self.hi = lo, hi
+    self.limit = min(hi, max(lo, initial))
+    self.interval = interval
+    self._log = log
+    self._cond = threading.Condition()
+    self._active = 0
+    self._bytes = 0
+    self._window_start = time.monotonic()
+    self._last_rate = 0.0
+    self._last_decrease = float("-inf")
+    self._paused_until = 0.0
+
+  def _set_limit(self, new: int, why: str) -> None:
+    if new != self.limit:
+      if self._log is not None:
+        print(f"workers {self.limit} -> {new} ({why})", file=self._log)
+      self.limit = new
+
+  def acquire(self) -> None:
+    with self._cond:
+      while True:
+        wait_for = self._paused_until - time.monotonic()
+        if wait_for > 0:
+          self._cond.wait(wait_for)
+        elif self._active < self.limit:
+          self._active += 1
+          return
+        else:
+          self._cond.wait()
+
+  def release(self, nbytes: int = 0) -> None:
+    with self._cond:
+      self._active -= 1
+      self._bytes += nbytes
+      now = time.monotonic()
+      elapsed = now - self._window_start
+      if elapsed >= self.interval:
+        rate = self._bytes / elapsed
+        if rate > self._last_rate * 1.05 and self.limit < self.hi:
+          self._set_limit(self.limit + 1, f"{rate / 1e6:.1f} MB/s")
+        self._last_rate, self._bytes, self._window_start = rate, 0, now
+      self._cond.notify_all()
+
+  def on_error(self, exc: BaseException) -> None:
+    if not is_throttle(exc):
+      return
+    with self._cond:
+      now = time.monotonic()
+      delay = retry_after_seconds(exc)
+      if delay:
+        self._paused_until = max(self._paused_until, now + delay)
+      if now - self._last_decrease >= self.interval:
+        self._last_decrease = now
+        reason = f"HTTP {exc.code}" if isinstance(exc, HTTPError) else "timeout"
+        self._set_limit(max(self.lo, self.limit // 2), reason)
+        # Restart the sample so the next increase is judged at the new level
+        self._last_rate, self._bytes, self._window_start = 0.0, 0, now
+
+  def pause(self, seconds: float, why: str) -> None:
+    """Hold back all new acquisitions for seconds; running downloads continue."""
+    with self._cond:
+      self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+      if self._log is not None:
+        print(f"pausing downloads for {seconds:g}s ({why})", file=self._log)
+      self._cond.notify_all()
+
+
+class CircuitBreaker:
+  """Pauses the whole pool once ``threshold`` downloads in a row fail with 5xx.
+
+  Each trip pauses for ``cooldown`` seconds, doubling (up to RETRY_MAX_DELAY)
+  while the CDN keeps failing; a successful download resets it.
+  """
+
+  def __init__(self, controller: AimdController, *, threshold: int, cooldown: float) -> None:
+    self.controller = controller
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.trips = 0
+    self._lock = threading.Lock()
+    self._streak = 0
+    self._backoff = 0
+
+  def record(self, exc: BaseException | None) -> None:
+    """Feed one download outcome: None for success, else the error it raised."""
+    if exc is not None and not (isinstance(exc, HTTPError) and exc.code >= 500):
+      return
+    with self._lock:
+      if exc is None:
+        self._streak = self._backoff = 0
+        return
+      self._streak += 1
+      if self.threshold <= 0 or self._streak < self.threshold:
+        return
+      seconds = min(RETRY_MAX_DELAY, self.cooldown * (2**self._backoff))
+      self._streak = 0
+      self._backoff += 1
+      self.trips += 1
+    self.controller.pause(seconds, f"{self.threshold} consecutive 5xx")
+
+
+class TaskQueue:
+  """Bounded priority queue of download tasks with a cap on concurrent large transfers.
+
+  Tasks come out largest-first (or FIFO when ``by_size`` is off). Once
+  ``max_large`` large tasks are running, smaller ones are handed out instead.
+  Failed tasks come back through ``retry`` and wait out their delay here, so
+  no worker sleeps on them; ``get`` only reports the end once nothing is
+  queued, delayed or still running. ``cancel`` drops everything not yet started.
+  """
+
+  def __init__(
+    self, *, maxsize: int, large_size: int, max_large: int = 0, by_size: bool = True
+  ) -> None:
+    self.maxsize = maxsize
+    self.large_size = large_size
+    self.max_large = max_large
+    self.by_size = by_size
+    self._cond = threading.Condition()
+    self._large: list[tuple[int, int, Task]] = []
+    self._small: list[tuple[int, int, Task]] = []
+    self._delayed: list[tuple[float, int, Task]] = []  # (not before, seq, task)
+    self._seq = 0
+    self._large_active = 0
+    self._active = 0
+    self._closed = False
+    self._cancelled = False
+
+  def __len__(self) -> int:
+    with self._cond:
+      return len(self._large) + len(self._small) + len(self._delayed)
+
+  def is_large(self, task: Task) -> bool:
+    return self.max_large > 0 and task.size >= self.large_size
+
+  def _push(self, task: Task) -> None:
+    key = -task.size if self.by_size else 0
+    heap = self._large if self.is_large(task) else self._small
+    heapq.heappush(heap, (key, self._seq, task))
+    self._seq += 1
+
+  def put(self, task: Task) -> None:
+    with self._cond:
+      while len(self._large) + len(self._small) >= self.maxsize and not self._closed:
+        self._cond.wait()
+      if self._cancelled:
+        return
+      self._push(task)
+      self._cond.notify_all()
+
+  def retry(self, task: Task, delay: float) -> None:
+    """Re-enqueue a task that failed; it becomes eligible after delay seconds."""
+    with self._cond:
+      if self._cancelled:
+        return
+      heapq.heappush(self._delayed, (time.monotonic() + delay, self._seq, task))
+      self._seq += 1
+      self._cond.notify_all()
+
+  def get(self) -> Task | None:
+    """Next task to run, or None once closed and drained."""
+    with self._cond:
+      while True:
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+          self._push(heapq.heappop(self._delayed)[2])
+        can_large = self._large and self._large_active < self.max_large
+        if can_large and (not self._small or self._large[0] <= self._small[0]):
+          self._large_active += 1
+          task = heapq.heappop(self._large)[2]
+        elif self._small:
+          task = heapq.heappop(self._small)[2]
+        elif self._closed and not (self._large or self._delayed or self._active):
+          return None
+        else:
+          self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+          continue
+        self._active += 1
+        self._cond.notify_all()
+        return task
+
+  def done(self, task: Task) -> None:
+    with self._cond:
+      self._active -= 1
+      if self.is_large(task):
+        self._large_active -= 1
+      self._cond.notify_all()
+
+  def close(self) -> None:
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def cancel(self) -> int:
+    """Close and drop every queued or delayed task (later puts and retries too).
+
+    Tasks already handed out still finish; returns how many were dropped.
+    """
+    with self._cond:
+      dropped = len(self._large) + len(self._small) + len(self._delayed)
+      self._large.clear()
+      self._small.clear()
+      self._delayed.clear()
+      self._closed = self._cancelled = True
+      self._cond.notify_all()
+      return dropped
+
+
+def probe_size(*, opener: OpenerDirector, url: str, timeout: float, user_agent: str) -> int | None:
+  """Ask for the first byte only and read the total size from Content-Range/Length."""
+  req = Request(url, headers={"User-Agent": user_agent, "Range": "bytes=0-0"})
+  try:
+    with opener.open(req, timeout=timeout) as r:
+      if m := CONTENT_RANGE_RE.match(r.headers.get("Content-Range", "")):
+        return int(m.group(1))
+      length = r.headers.get("Content-Length", "")
+      return int(length) if r.status == 200 and length.isdigit() else None
+  except NET_ERRORS:
+    return None
+
+
+class OutputLayout:
+  """Maps base names to their output directory, listing each shard only when first used."""
+
+  def __init__(self, root: Path, layout: str = "flat") -> None:
+    if layout not in ("flat", "year", "year/month"):
+      raise ValueError(f"unknown layout: {layout!r}")
+    self.root = root
+    self.layout = layout
+    self._lock = threading.Lock()
+    self._names: dict[Path, set[str]] = {}
+    self._prefixes: dict[Path, set[str]] = {}
+
+  def shard_for(self, base: str) -> Path:
+    # base comes from build_base_name: YYYY-MM-DD_HH-MM-SS[-dup-N]
+    if self.layout == "year":
+      return self.root / base[:4]
+    if self.layout == "year/month":
+      return self.root / base[:4] / base[5:7]
+    return self.root
+
+  def names(self, shard: Path) -> set[str]:
+    """Live set of file names in shard (created on demand), shared with make_unique_name."""
+    with self._lock:
+      names = self._names.get(shard)
+      if names is None:
+        shard.mkdir(parents=True, exist_ok=True)
+        with os.scandir(shard) as it:
+          names = {e.name for e in it if e.is_file()}
+        self._names[shard] = names
+      return names
+
+  def prefixes(self, shard: Path) -> set[str]:
+    """Base names already present in shard, for --skip-existing."""
+    names = self.names(shard)
+    with self._lock:
+      prefixes = self._prefixes.get(shard)
+      if prefixes is None:
+        prefixes = {n.rsplit("_", 1)[0] if "_" in n else n.rsplit(".", 1)[0] for n in names}
+        self._prefixes[shard] = prefixes
+      return prefixes
+
+
+def probe_status(
+  *, opener: OpenerDirector, url: str, timeout: float, user_agent: str
+) -> int | None:
+  """HTTP status for a 1-byte range GET of url (None on network errors)."""
+  req = Request(url, headers={"User-Agent": user_agent, "Range": "bytes=0-0"})
+  try:
+    with opener.open(req, timeout=timeout) as r:
+      return r.status
+  except HTTPError as e:
+    return e.code
+  except NET_ERRORS:
+    return None
+
+
+class DirListing:
+  """One directory's visible entries, read lazily from os.scandir and kept sorted.
+
+  Entry types come from the DirEntry (d_type), so building or redrawing a listing
+  never stats each file; large or slow directories are loaded in batches.
+  Batches are merged into the sorted entries once they add up to a quarter of
+  them, so a listing is re-sorted O(log n) times rather than once per batch.
+  """
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.entries: list[tuple[str, bool]] = []  # (name, is_dir), dirs first
+    self._pending: list[tuple[str, bool]] = []  # read but not merged into entries yet
+    self._it: Any = None  # os.scandir iterator while entries remain
+    try:
+      self._it = os.scandir(path)
+    except OSError:
+      pass
+
+  @property
+  def done(self) -> bool:
+    return self._it is None
+
+  def load(self, limit: int = TUI_BATCH) -> None:
+    """Read up to limit more entries; closes the scandir iterator at the end."""
+    if self._it is None:
+      return
+    batch: list[tuple[str, bool]] = []
+    read = 0
+    try:
+      for e in itertools.islice(self._it, limit):
+        read += 1
+        if e.name.startswith("."):
+          continue
+        try:
+          batch.append((e.name, e.is_dir()))
+        except OSError:
+          batch.append((e.name, False))
+      finished = read < limit
+    except OSError:
+      finished = True
+    self._pending.extend(batch)
+    if self._pending and (finished or len(self._pending) >= max(limit, len(self.entries) // 4)):
+      self.entries.extend(self._pending)
+      self.entries.sort(key=listing_key)
+      self._pending = []
+    if finished:
+      self.close()
+
+  def close(self) -> None:
+    if self._it is not None:
+      self._it.close()
+      self._it = None
+
+
+def listing_key(entry: tuple[str, bool]) -> tuple[bool, str]:
+  return (not entry[1], entry[0].lower())
+
+
+def fuzzy_score(query: str, name: str) -> int | None:
+  """Subsequence match of query in name (case-insensitive); lower is better, None if no match."""
+  if not query:
+    return 0
+  hay = name.lower()
+  pos, score = -1, 0
+  for ch in query.lower():
+    nxt = hay.find(ch, pos + 1)
+    if nxt < 0:
+      return None
+    score += nxt - pos - 1  # skipped characters, including any before the first match
+    pos = nxt
+  return score
+
+
+def fuzzy_filter(entries: list[tuple[str, bool]], query: str) -> list[tuple[str, bool]]:
+  if not query:
+    return entries
+  scored = [(sc, i) for i, e in enumerate(entries) if (sc := fuzzy_score(query, e[0])) is not None]
+  return [entries[i] for _, i in sorted(scored)]
+
+
 def tui_select_path(*, title: str, start: Path, mode: str) -> Path:
   if not sys.stdin.isatty() or not sys.stdout.isatty():
     die("TUI requires TTY. Use --json/--out or --no-tui.")
   if mode not in ("file", "dir"):
     raise ValueError("mode must be 'file' or 'dir'")
   start = start.expanduser().resolve() if start.exists() else Path.cwd().resolve()
+  listings: dict[Path, DirListing] = {}
+
+  def listing(path: Path) -> DirListing:
+    if path not in listings:
+      listings[path] = DirListing(path)
+    return listings[path]
 
   def run(stdscr: curses.window) -> Path:
     curses.curs_set(0)
     stdscr.keypad(True)
     cwd, idx = start, 0
-    last_cwd: Path | None = None
-    entries: list[Path] = []
+    query: str | None = None  # None: not filtering
+    positions: dict[Path, int] = {}
+
+    def enter(path: Path) -> None:
+      nonlocal cwd, idx, query
+      positions[cwd] = idx
+      cwd, query = path, None
+      idx = positions.get(cwd, 0)
+
     while True:
-      if cwd != last_cwd:
-        try:
-          entries = sorted(
-            [p for p in cwd.iterdir() if not p.name.startswith(".")],
-            key=lambda p: (not p.is_dir(), p.name.lower()),
-          )
-        except OSError:
-          entries = []
-        last_cwd = cwd
-      shown: list[Path] = [cwd.parent, *entries]
+      cur = listing(cwd)
+      cur.load()
+      # Keep polling input while a big directory is still streaming in
+      stdscr.timeout(-1 if cur.done else 0)
+      matches = fuzzy_filter(cur.entries, query or "")
+      shown = [("..", True), *matches] if query is None else matches
       idx = min(idx, max(0, len(shown) - 1))
       stdscr.erase()
       h, w = stdscr.getmaxyx()
-      stdscr.addnstr(0, 0, f"{title} [{mode}] cwd: {cwd}", w - 1)
-      stdscr.addnstr(1, 0, "↑↓/jk: move Enter: select Backspace: up q: quit", w - 1)
+      status = "" if cur.done else f" (loading {len(cur.entries)}…)"
+      stdscr.addnstr(0, 0, f"{title} [{mode}] cwd: {cwd}{status}", w - 1)
+      if query is None:
+        help_line = "↑↓/jk: move Enter: select Backspace: up /: filter r: reload q: quit"
+      else:
+        help_line = f"/{query}   ({len(matches)} match) Enter: select Esc: clear"
+      stdscr.addnstr(1, 0, help_line, w - 1)
       row0, max_rows = 3, max(1, h - 4)
       top = max(0, idx - max_rows + 1)
       for i in range(top, min(len(shown), top + max_rows)):
-        p = shown[i]
-        name = ".." if i == 0 else p.name + ("/" if p.is_dir() else "")
+        name, is_dir = shown[i]
+        label = name + ("/" if is_dir and name != ".." else "")
         attr = curses.A_REVERSE if i == idx else 0
-        stdscr.addnstr(row0 + i - top, 0, name, w - 1, attr)
+        stdscr.addnstr(row0 + i - top, 0, label, w - 1, attr)
       stdscr.refresh()
       k = stdscr.getch()
+      if k == -1:
+        continue
+      if query is not None:
+        if k == 27:
+          query, idx = None, 0
+          continue
+        if k in (curses.KEY_BACKSPACE, 127, 8):
+          query, idx = (query[:-1] if query else None), 0
+          continue
+        if 32 <= k < 127:
+          query, idx = query + chr(k), 0
+          continue
       if k in (ord("q"), 27):
         raise KeyboardInterrupt
-      if k in (curses.KEY_UP, ord("k")):
+      if k == ord("/") and query is None:
+        query, idx = "", 0
+      elif k == ord("r") and query is None:
+        listings.pop(cwd).close()
+      elif k in (curses.KEY_UP, ord("k")):
         idx = max(0, idx - 1)
       elif k in (curses.KEY_DOWN, ord("j")):
         idx = min(len(shown) - 1, idx + 1)
       elif k in (curses.KEY_BACKSPACE, 127, 8):
-        cwd, idx = cwd.parent, 0
-      elif k in (curses.KEY_ENTER, 10, 13):
-        pick = shown[idx]
-        if idx == 0:
-          cwd, idx = cwd.parent, 0
-        elif pick.is_dir():
+        enter(cwd.parent)
+      elif k in (curses.KEY_ENTER, 10, 13) and shown:
+        name, is_dir = shown[idx]
+        pick = cwd / name
+        if query is None and idx == 0:
+          enter(cwd.parent)
+        elif is_dir:
           if mode == "dir":
             return pick
-          cwd, idx = pick, 0
-        elif mode == "file" and JSON_NAME_RE.search(pick.name):
+          enter(pick)
+        elif mode == "file" and JSON_NAME_RE.search(name):
           return pick
     return cwd
 
@@ -191,48 +1179,245 @@ def tui_select_path(*, title: str, start: Path, mode: str) -> Path:
     return curses.wrapper(run)
   except KeyboardInterrupt:
     die("Aborted.")
+  finally:
+    for cached in listings.values():
+      cached.close()
 
 
-def download_to_path(
-  *, opener: OpenerDirector, url: str, dest: Path, timeout: float, user_agent: str
-) -> None:
-  tmp = dest.with_suffix(dest.suffix + ".part")
-  req = Request(url, headers={"User-Agent": user_agent})
-  with opener.open(req, timeout=timeout) as r, open(tmp, "wb") as f:
-    while chunk := r.read(CHUNK_SIZE):
-      f.write(chunk)
-  os.replace(tmp, dest)
+@dataclass(slots=True)
+class Payload:
+  """A downloaded body, either buffered in memory or spilled to a file on disk."""
+
+  size: int
+  buf: io.BytesIO | None = None
+  path: Path | None = None
+  digest: str | None = None
 
+  def open(self) -> BinaryIO:
+    if self.buf is not None:
+      self.buf.seek(0)
+      return self.buf
+    assert self.path is not None
+    return open(self.path, "rb")
 
-def download_with_retries(
+  def is_zip(self) -> bool:
+    if self.buf is not None:
+      return zipfile.is_zipfile(self.buf)
+    return self.path is not None and zipfile.is_zipfile(self.path)
+
+  def discard(self) -> None:
+    self.buf = None
+    if self.path is not None:
+      self.path.unlink(missing_ok=True)
+
+
+_recv_local = threading.local()
+
+
+def recv_buffer(size: int) -> memoryview:
+  """Per-thread receive buffer reused across downloads instead of a new bytes per chunk."""
+  buf: bytearray | None = getattr(_recv_local, "buf", None)
+  if buf is None or len(buf) < size:
+    buf = _recv_local.buf = bytearray(size)
+  return memoryview(buf)[:size]
+
+
+def open_part(path: Path, length: int | None) -> io.FileIO:
+  """Unbuffered writer for a .part file, preallocated to length when it is known."""
+  f = open(path, "wb", buffering=0)
+  if length and hasattr(os, "posix_fallocate"):
+    try:
+      os.posix_fallocate(f.fileno(), 0, length)
+    except OSError:
+      pass  # Best effort: some filesystems (FUSE, older NFS) refuse fallocate
+  return f
+
+
+def write_all(f: io.FileIO, view: memoryview) -> None:
+  while view:
+    view = view[f.write(view) :]
+
+
+def download_to_path(
   *,
   opener: OpenerDirector,
   url: str,
   dest: Path,
   timeout: float,
   user_agent: str,
-  retries: int,
-  backoff: float,
-) -> None:
-  last_exc: Exception | None = None
-  for attempt in range(retries + 1):
+  limiter: TokenBucket | None = None,
+  conn_rate: float = 0.0,
+  mem_limit: int = 0,
+  digest: bool = False,
+  write_buffer: int = 0,
+  stats: RunStats | None = None,
+) -> Payload:
+  """Fetch url; bodies up to mem_limit stay in memory, larger ones land at dest.
+
+  Data is received with readinto: known-length in-memory bodies go straight
+  into their final buffer, everything else through a reusable per-thread
+  buffer that is flushed to disk in write_buffer-sized writes.
+  """
+  tmp = dest.with_suffix(dest.suffix + ".part")
+  req = Request(url, headers={"User-Agent": user_agent})
+  limiters = [b for b in (limiter, TokenBucket(conn_rate) if conn_rate > 0 else None) if b]
+  rates = [rate for b in limiters if (rate := b.current_rate()) > 0]
+  # Smaller reads under a cap so the socket drains smoothly instead of in 1 MiB bursts
+  step = min(CHUNK_SIZE, max(16384, int(min(rates) / 8))) if rates else CHUNK_SIZE
+  total = 0
+  h = hashlib.blake2b(digest_size=20) if digest else None
+
+  # Bytes are credited to the second they arrive in, flushed once per second
+  window, window_bytes = (stats.second() if stats is not None else 0), 0
+
+  def take(view: memoryview) -> None:
+    nonlocal window, window_bytes
+    for bucket in limiters:
+      bucket.consume(len(view))
+    if h is not None:
+      h.update(view)
+    if stats is not None:
+      if (second := stats.second()) != window:
+        stats.record_transfer(window, window_bytes)
+        window, window_bytes = second, 0
+      window_bytes += len(view)
+
+  started = time.monotonic()
+  try:
+    with opener.open(req, timeout=timeout) as r:
+      ttfb = time.monotonic() - started
+      cl = r.headers.get("Content-Length") or ""
+      length = int(cl) if cl.isdigit() else None
+      if mem_limit > 0 and length is not None and length <= mem_limit:
+        buf = io.BytesIO()
+        if length:
+          buf.seek(length - 1)
+          buf.write(b"\0")
+        with buf.getbuffer() as mv:
+          while total < length and (n := r.readinto(mv[total : total + step])):
+            take(mv[total : total + n])
+            total += n
+        if total < length:
+          raise http.client.IncompleteRead(b"", length - total)
+        buf.truncate(total)
+        if stats is not None:
+          stats.record_response(ttfb, time.monotonic() - started, total)
+        return Payload(size=total, buf=buf, digest=h.hexdigest() if h is not None else None)
+
+      mem: io.BytesIO | None = io.BytesIO() if mem_limit > 0 and length is None else None
+      chunk = recv_buffer(max(step, write_buffer))
+      f: io.FileIO | None = None
+      filled = 0
+      try:
+        if mem is None:
+          f = open_part(tmp, length)
+        while n := r.readinto(chunk[filled : filled + step]):
+          view = chunk[filled : filled + n]
+          take(view)
+          total += n
+          if mem is not None:
+            mem.write(view)
+            if total > mem_limit:
+              # Unknown length turned out large: spill what we have and continue on disk
+              f = open_part(tmp, None)
+              write_all(f, mem.getbuffer())
+              mem = None
+            continue
+          filled += n
+          if filled + step > len(chunk):
+            write_all(f, chunk[:filled])
+            filled = 0
+        # urllib's read/readinto return short data instead of raising on a dropped body
+        if length is not None and total < length:
+          raise http.client.IncompleteRead(b"", length - total)
+        if f is not None:
+          write_all(f, chunk[:filled])
+      except BaseException:
+        if f is not None:
+          f.close()
+          tmp.unlink(missing_ok=True)
+        raise
+      finally:
+        if f is not None:
+          f.close()
+  finally:
+    if stats is not None:
+      stats.record_transfer(window, window_bytes)
+  if stats is not None:
+    stats.record_response(ttfb, time.monotonic() - started, total)
+  hexdigest = h.hexdigest() if h is not None else None
+  if mem is not None:
+    return Payload(size=total, buf=mem, digest=hexdigest)
+  os.replace(tmp, dest)
+  return Payload(size=total, path=dest, digest=hexdigest)
+
+
+class DedupeIndex:
+  """Content digest -> stored file, persisted next to the downloads across runs.
+
+  ``link`` mode turns a repeated file into a hardlink of the first copy,
+  ``skip`` mode does not store it at all. Either way the bytes are counted.
+  """
+
+  def __init__(self, out_dir: Path, mode: str) -> None:
+    self.out_dir = out_dir
+    self.mode = mode
+    self.duplicates = 0
+    self.saved_bytes = 0
+    self._lock = threading.Lock()
+    self._paths: dict[str, Path] = {}
+    self._index_path = out_dir / DEDUPE_INDEX_NAME
     try:
-      download_to_path(
-        opener=opener, url=url, dest=dest, timeout=timeout, user_agent=user_agent
-      )
-      return
-    except (HTTPError, URLError, TimeoutError, OSError) as e:
-      last_exc = e
-      if attempt < retries:
-        time.sleep(backoff * (2**attempt))
-  if last_exc:
-    raise last_exc
-  raise RuntimeError("download failed")
+      with self._index_path.open("r", encoding="utf-8") as f:
+        for line in f:
+          digest, _, rel = line.rstrip("\n").partition("\t")
+          if rel:
+            self._paths[digest] = out_dir / rel
+    except FileNotFoundError:
+      pass
+
+  def reuse(self, digest: str, size: int, target: Callable[[], Path]) -> str | None:
+    """Handle a repeat of stored content: returns the linked name, "" if skipped, None if new."""
+    with self._lock:
+      src = self._paths.get(digest)
+    if src is None or not src.is_file():
+      return None
+    if self.mode == "skip":
+      name = ""
+    else:
+      dest = target()
+      temp = dest.with_suffix(dest.suffix + ".part")
+      try:
+        temp.unlink(missing_ok=True)
+        os.link(src, temp)
+        os.replace(temp, dest)
+      except OSError:
+        temp.unlink(missing_ok=True)
+        return None  # e.g. no hardlinks on this filesystem: store a real copy
+      name = dest.name
+    with self._lock:
+      self.duplicates += 1
+      self.saved_bytes += size
+    return name
+
+  def add(self, digest: str, path: Path) -> None:
+    with self._lock:
+      if digest in self._paths and self._paths[digest].is_file():
+        return
+      self._paths[digest] = path
+      with self._index_path.open("a", encoding="utf-8") as f:
+        f.write(f"{digest}\t{path.relative_to(self.out_dir).as_posix()}\n")
 
 
 def extract_zip_atomically(
-  zip_path: Path, base_name: str, out_dir: Path, existing: set[str], lock: threading.Lock
+  zip_path: Path | BinaryIO,
+  base_name: str,
+  out_dir: Path,
+  existing: set[str],
+  lock: threading.Lock,
+  dedupe: DedupeIndex | None = None,
 ) -> list[str]:
+  """Extract known members of a captioned-memory ZIP; a zip_path on disk is removed."""
   extracted: list[str] = []
   try:
     with zipfile.ZipFile(zip_path, "r") as z:
@@ -258,112 +1443,360 @@ def extract_zip_atomically(
         # Use .part suffix for atomicity
         temp_path = target_path.with_suffix(target_path.suffix + ".part")
 
+        h = hashlib.blake2b(digest_size=20) if dedupe is not None else None
         with z.open(member) as source, open(temp_path, "wb") as target:
-          shutil.copyfileobj(source, target)
+          if h is None:
+            shutil.copyfileobj(source, target)
+          else:
+            while chunk := source.read(CHUNK_SIZE):
+              h.update(chunk)
+              target.write(chunk)
 
-        os.replace(temp_path, target_path)
+        if dedupe is not None and h is not None:
+          digest = h.hexdigest()
+          reused = dedupe.reuse(digest, member.file_size, lambda: target_path)
+          if reused is not None:
+            temp_path.unlink(missing_ok=True)
+            if reused:
+              extracted.append(reused)
+            continue
+          os.replace(temp_path, target_path)
+          dedupe.add(digest, target_path)
+        else:
+          os.replace(temp_path, target_path)
         extracted.append(final_name)
   finally:
-    zip_path.unlink(missing_ok=True)
+    if isinstance(zip_path, Path):
+      zip_path.unlink(missing_ok=True)
   return extracted
 
 
+def store_payload(
+  payload: Payload,
+  *,
+  base: str,
+  is_video: bool,
+  out_dir: Path,
+  existing: set[str],
+  lock: threading.Lock,
+  dedupe: DedupeIndex | None = None,
+) -> list[str]:
+  """Extract a ZIP payload or move a plain media payload to its final name."""
+  if payload.is_zip():
+    src = payload.path if payload.path is not None else payload.open()
+    return extract_zip_atomically(src, base, out_dir, existing, lock, dedupe)
+  suffix = ".mp4" if is_video else ".jpg"
+  if dedupe is not None and payload.digest is not None:
+    reused = dedupe.reuse(
+      payload.digest,
+      payload.size,
+      lambda: out_dir / make_unique_name(base, suffix, existing, lock),
+    )
+    if reused is not None:
+      payload.discard()
+      return [reused] if reused else []
+  final_name = make_unique_name(base, suffix, existing, lock)
+  target = out_dir / final_name
+  if payload.path is not None:
+    os.replace(payload.path, target)
+  else:
+    assert payload.buf is not None
+    temp_path = target.with_suffix(target.suffix + ".part")
+    with open(temp_path, "wb") as f:
+      f.write(payload.buf.getbuffer())
+    os.replace(temp_path, target)
+  if dedupe is not None and payload.digest is not None:
+    dedupe.add(payload.digest, target)
+  return [final_name]
+
+
 def main(argv: list[str]) -> int:
   ns = parse_args(argv)
-  json_path_s = ns.json_path.strip().strip('"\'')
+  json_specs = [s for s in (raw.strip().strip('"\'') for raw in ns.json_paths) if s]
   out_dir_s = ns.out_dir.strip().strip('"\'')
-  json_path: Path | None = Path(json_path_s) if json_path_s else None
+  json_paths = [Path(s) for s in json_specs]
   out_dir: Path | None = Path(out_dir_s) if out_dir_s else None
-  if json_path is None and not ns.no_tui:
-    json_path = tui_select_path(
-      title="Select memories_history.json", start=Path.cwd(), mode="file"
-    )
+  if not json_paths and not ns.no_tui:
+    json_paths = [
+      tui_select_path(title="Select memories_history.json", start=Path.cwd(), mode="file")
+    ]
   if out_dir is None and not ns.no_tui:
     out_dir = tui_select_path(title="Select output directory", start=Path.cwd(), mode="dir")
-  if json_path is None:
+  if not json_paths:
     die("Missing --json (or omit --no-tui for TUI).")
   if out_dir is None:
     die("Missing --out (or omit --no-tui for TUI).")
-  json_path, out_dir = json_path.expanduser(), out_dir.expanduser()
-  if not json_path.is_file():
-    die(f"JSON does not exist: {json_path}")
+  json_paths = find_exports([p.expanduser() for p in json_paths])
+  out_dir = out_dir.expanduser()
   out_dir.mkdir(parents=True, exist_ok=True)
-  items = load_items(json_path, ns.media_type)
-  if not items:
-    print("No media items found.")
-    return 0
-  existing = {p.name for p in out_dir.iterdir() if p.is_file()}
-  existing_prefixes = {
-    name.rsplit("_", 1)[0] if "_" in name else name.rsplit(".", 1)[0] for name in existing
-  }
+  layout = OutputLayout(out_dir, ns.layout)
+  if ns.max_workers is None:
+    ns.max_workers = max(16, ns.workers)
+  if not 1 <= ns.min_workers <= ns.workers <= ns.max_workers:
+    die("Need 1 <= --min-workers <= --workers <= --max-workers.")
+  try:
+    limiter = TokenBucket(parse_rate(ns.max_rate), schedule=parse_rate_schedule(ns.rate_schedule))
+    conn_rate = parse_rate(ns.max_rate_per_conn)
+    mem_limit = parse_size(ns.mem_threshold)
+    large_size = parse_size(ns.large_size)
+    write_buffer = parse_size(ns.write_buffer)
+  except ValueError as e:
+    die(str(e))
   lock = threading.Lock()
+  seen_bases: dict[str, int] = {}
+  dedupe = DedupeIndex(out_dir, ns.dedupe) if ns.dedupe != "off" else None
+  stats = RunStats() if ns.stats_json else None
   opener = build_opener()
+  controller = AimdController(
+    initial=ns.workers,
+    lo=ns.min_workers,
+    hi=ns.max_workers,
+    interval=ns.adapt_interval,
+    log=sys.stderr,
+  )
 
-  download_tasks: list[tuple[Item, str]] = []
-  seen_bases = {}
-
-  for it in items:
-    try:
-      base_orig = build_base_name(it.date_str)
-    except ValueError as e:
-      print(f"FAIL bad date '{it.date_str}': {e}", file=sys.stderr)
-      continue
-
-    if base_orig in seen_bases:
-      seen_bases[base_orig] += 1
-      base = f"{base_orig}-dup-{seen_bases[base_orig]}"
-    else:
-      seen_bases[base_orig] = 0
-      base = base_orig
-
-    if ns.skip_existing and base in existing_prefixes:
-      continue
-    download_tasks.append((it, base))
-
-  if ns.dry_run:
-    for it, base in download_tasks:
-      print(f"DRY {base} <- {it.url}")
-    print(f"Done. Would download {len(download_tasks)} files.")
-    return 0
-
-  ok, failed = 0, 0
+  breaker = CircuitBreaker(
+    controller, threshold=ns.breaker_threshold, cooldown=ns.breaker_cooldown
+  )
 
-  def download_item(task: tuple[Item, str]) -> bool:
-    it, base = task
-    zip_path = out_dir / f"{base}_memory.zip"
+  def fetch(task: Task) -> Payload | None:
+    """One attempt; a retryable failure goes back on the queue with a jittered delay."""
+    shard = layout.shard_for(task.base)
+    layout.names(shard)  # creates the shard: bodies past --mem-threshold spill into it
+    zip_path = shard / f"{task.base}_memory.zip"
     try:
-      download_with_retries(
+      payload = download_to_path(
         opener=opener,
-        url=it.url,
+        url=task.item.url,
         dest=zip_path,
         timeout=ns.timeout,
         user_agent=ns.user_agent,
-        retries=ns.retries,
-        backoff=ns.retry_backoff,
+        limiter=limiter,
+        conn_rate=conn_rate,
+        mem_limit=mem_limit,
+        digest=dedupe is not None,
+        write_buffer=write_buffer,
+        stats=stats,
       )
-      if zipfile.is_zipfile(zip_path):
-        extracted = extract_zip_atomically(zip_path, base, out_dir, existing, lock)
-        for name in extracted:
-          print(f"✓ {name}")
+    except NET_ERRORS as e:
+      controller.on_error(e)
+      breaker.record(e)
+      retry = task.attempt < ns.retries and not is_permanent(e)
+      if stats is not None:
+        stats.record_error(e, retried=retry)
+      if retry:
+        delay = retry_delay(task.attempt, ns.retry_backoff, e)
+        task.attempt += 1
+        queue.retry(task, delay)
       else:
-        ext = ".mp4" if it.is_video else ".jpg"
-        final_name = make_unique_name(base, ext, existing, lock)
-        os.replace(zip_path, out_dir / final_name)
-        print(f"✓ {final_name}")
+        print(f"✗ {task.base}: {e}", file=sys.stderr)
+        zip_path.unlink(missing_ok=True)
+        count(False)
+      return None
+    breaker.record(None)
+    return payload
+
+  def store(task: Task, payload: Payload) -> bool:
+    shard = layout.shard_for(task.base)
+    started = time.monotonic()
+    try:
+      for name in store_payload(
+        payload,
+        base=task.base,
+        is_video=task.item.is_video,
+        out_dir=shard,
+        existing=layout.names(shard),
+        lock=lock,
+        dedupe=dedupe,
+      ):
+        print(f"✓ {name}")
       return True
-    except (HTTPError, URLError, TimeoutError, OSError) as e:
-      print(f"✗ {base}: {e}", file=sys.stderr)
-      zip_path.unlink(missing_ok=True)
+    except (OSError, zipfile.BadZipFile) as e:
+      print(f"✗ {task.base}: {e}", file=sys.stderr)
+      payload.discard()
       return False
+    finally:
+      if stats is not None:
+        stats.record_extract(time.monotonic() - started)
+
+  total, queued, ok, failed = 0, 0, 0, 0
+  queue = TaskQueue(
+    maxsize=max(1, ns.lookahead),
+    large_size=large_size,
+    max_large=ns.max_large,
+    by_size=ns.order == "size",
+  )
 
-  with ThreadPoolExecutor(max_workers=ns.workers) as executor:
-    futures = {executor.submit(download_item, task): task for task in download_tasks}
-    for future in as_completed(futures):
-      if future.result():
+  def count(good: bool) -> None:
+    nonlocal ok, failed
+    with lock:
+      if good:
         ok += 1
       else:
         failed += 1
-  skipped = len(items) - len(download_tasks)
+
+  def store_and_count(task: Task, payload: Payload) -> None:
+    try:
+      count(store(task, payload))
+    finally:
+      extract_slots.release()
+
+  def worker() -> None:
+    while True:
+      # Take a concurrency slot first so waiting workers don't sit on popped tasks
+      controller.acquire()
+      payload: Payload | None = None
+      task = queue.get()
+      try:
+        if task is None:
+          return
+        payload = fetch(task)
+      finally:
+        if task is not None:
+          queue.done(task)
+        controller.release(payload.size if payload is not None else 0)
+      if payload is None:
+        continue  # failed for good (already counted) or re-queued for a retry
+      if extractor is None:
+        count(store(task, payload))
+      else:
+        # Back-pressure: stop fetching while extraction is behind, but off the network slot
+        extract_slots.acquire()
+        extractor.submit(store_and_count, task, payload).add_done_callback(keep_error)
+
+  def keep_error(future: Future[None]) -> None:
+    if (exc := future.exception()) is not None:
+      extract_errors.append(exc)
+
+  def probe_and_put(task: Task) -> None:
+    try:
+      size = probe_size(
+        opener=opener, url=task.item.url, timeout=ns.timeout, user_agent=ns.user_agent
+      )
+      if size is not None:
+        task.size = size
+    finally:
+      queue.put(task)
+      probe_slots.release()
+
+  merged = MergedItems(json_paths, ns.media_type)
+  items: Iterator[Item] = iter(merged)
+  if ns.preflight > 0 and not ns.dry_run and ns.expired != "download":
+    # Stale exports reject every link; find out now instead of after hours of backoff.
+    # Each export is sampled: a newer one can supply what an expired one cannot.
+    codes: list[int | None] = []
+    for json_path in json_paths:
+      sample = list(itertools.islice(iter_items(json_path, ns.media_type), ns.preflight))
+      export_codes = [
+        probe_status(opener=opener, url=it.url, timeout=ns.timeout, user_agent=ns.user_agent)
+        for it in sample
+      ]
+      if len(json_paths) > 1 and sample and all(c in DEAD_LINK_CODES for c in export_codes):
+        print(f"Pre-flight: every sampled link in {json_path} was rejected", file=sys.stderr)
+      codes.extend(export_codes)
+    if codes and all(code in DEAD_LINK_CODES for code in codes):
+      die(
+        f"Pre-flight: all {len(codes)} sampled links were rejected "
+        f"(HTTP {', '.join(map(str, codes))}); the export's signed URLs have likely expired.\n"
+        "Request a fresh export, or pass --expired download to try anyway."
+      )
+
+  expired = 0
+  aborted = ""
+  now = time.time()
+  extractor = ThreadPoolExecutor(max_workers=ns.extract_workers) if ns.extract_workers > 0 else None
+  extract_slots = threading.BoundedSemaphore(max(1, ns.extract_queue))
+  extract_errors: list[BaseException] = []
+  probe_slots = threading.BoundedSemaphore(max(1, ns.probe_workers) * 4)
+  # One thread per possible slot; the controller decides how many run at once
+  with (
+    ThreadPoolExecutor(max_workers=controller.hi) as executor,
+    ThreadPoolExecutor(max_workers=max(1, ns.probe_workers)) as prober,
+  ):
+    workers = [] if ns.dry_run else [executor.submit(worker) for _ in range(controller.hi)]
+    try:
+      for it in items:
+        total += 1
+        if ns.expired != "download" and (exp := url_expiry(it.url)) is not None and exp < now:
+          expired += 1
+          if ns.expired == "abort":
+            when = datetime.fromtimestamp(exp, timezone.utc).strftime(DATE_FMT)
+            aborted = f"Link for {it.date_str} expired at {when}; request a fresh export."
+            # Stop now: drop queued downloads and pending probes, finish only in-flight ones
+            prober.shutdown(wait=False, cancel_futures=True)
+            queue.cancel()
+            break
+          continue
+        try:
+          base_orig = build_base_name(it.date_str)
+        except ValueError as e:
+          print(f"FAIL bad date '{it.date_str}': {e}", file=sys.stderr)
+          continue
+
+        if base_orig in seen_bases:
+          seen_bases[base_orig] += 1
+          base = f"{base_orig}-dup-{seen_bases[base_orig]}"
+        else:
+          seen_bases[base_orig] = 0
+          base = base_orig
+
+        if ns.skip_existing and base in layout.prefixes(layout.shard_for(base)):
+          continue
+        queued += 1
+        if ns.dry_run:
+          print(f"DRY {base} <- {it.url}")
+          continue
+        task = Task(it, base, VIDEO_SIZE_PRIOR if it.is_video else IMAGE_SIZE_PRIOR)
+        if ns.probe:
+          probe_slots.acquire()
+          prober.submit(probe_and_put, task)
+        else:
+          queue.put(task)
+      prober.shutdown(wait=True)
+    finally:
+      queue.close()
+    try:
+      for future in workers:
+        future.result()
+    finally:
+      if extractor is not None:
+        extractor.shutdown(wait=True)
+  if extract_errors:
+    raise extract_errors[0]
+  if aborted:
+    die(aborted)
+
+  if total == 0:
+    print("No media items found.")
+    return 0
+  if len(json_paths) > 1:
+    print(f"Merged {len(json_paths)} exports: {merged.duplicates} repeated entries dropped")
+  if expired:
+    print(f"Expired: {expired} links skipped (signature past its expiry)", file=sys.stderr)
+  if ns.dry_run:
+    print(f"Done. Would download {queued} files.")
+    return 0
+  skipped = total - queued
+  if dedupe is not None:
+    verb = "linked" if dedupe.mode == "link" else "skipped"
+    print(
+      f"Dedupe: {dedupe.duplicates} duplicates {verb}, "
+      f"saved {dedupe.saved_bytes / 1024**2:.1f} MiB"
+    )
+  if stats is not None:
+    report = stats.to_dict(
+      ok=ok,
+      skipped=skipped,
+      failed=failed,
+      expired=expired,
+      merged_duplicates=merged.duplicates,
+      breaker_trips=breaker.trips,
+      workers={"final": controller.limit, "min": controller.lo, "max": controller.hi},
+      timeout_s=ns.timeout,
+      dedupe_saved_bytes=dedupe.saved_bytes if dedupe is not None else 0,
+    )
+    with open(Path(ns.stats_json).expanduser(), "w", encoding="utf-8") as f:
+      json.dump(report, f, indent=2)
   print(f"Done. ok={ok} skipped={skipped} failed={failed}")
   return 0 if failed == 0 else 2
 
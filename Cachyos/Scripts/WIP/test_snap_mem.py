@@ -1,8 +1,19 @@
 import unittest
+import contextlib
+import http.client
 import importlib.util
+import io
+import json
+import os
 import sys
+import tempfile
 import threading
+import time
+import zipfile
+from email.message import Message
 from pathlib import Path
+from unittest import mock
+from urllib.error import HTTPError, URLError
 
 # Import snap-mem.py using importlib because of the hyphen in the filename
 path = Path(__file__).parent / "snap-mem.py"
@@ -11,6 +22,33 @@ snap_mem = importlib.util.module_from_spec(spec)
 sys.modules["snap_mem"] = snap_mem
 spec.loader.exec_module(snap_mem)
 
+import bench_snap_mem
+
+
+class FakeResponse(io.BytesIO):
+    status = 200
+
+    def __init__(self, body, headers=None):
+        super().__init__(body)
+        self.headers = headers if headers is not None else {"Content-Length": str(len(body))}
+
+
+class FakeOpener:
+    def __init__(self, body, headers=None):
+        self.body, self.headers = body, headers
+
+    def open(self, req, timeout=None):
+        return FakeResponse(self.body, self.headers)
+
+
+def make_zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    return buf.getvalue()
+
+
 class TestSnapMem(unittest.TestCase):
     def test_build_base_name_valid(self):
         # Format: %Y-%m-%d %H:%M:%S UTC
@@ -80,5 +118,641 @@ class TestSnapMem(unittest.TestCase):
         self.assertEqual(name, "base_4.jpg")
         self.assertIn("base_4.jpg", existing)
 
+    def test_iter_saved_media_small_reads(self):
+        # Tiny read size forces values to straddle buffer boundaries
+        doc = {
+            "Other": {"n": 12345, "s": "x" * 50},
+            "Saved Media": [
+                {"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Video", "n": 1234567},
+                {"Date": "2023-01-02 12:00:00 UTC", "Media Type": "Image"},
+            ],
+            "Tail": 98765,
+        }
+        f = io.StringIO(json.dumps(doc, indent=2))
+        stream = snap_mem.JsonStream(f, read_size=7)
+        self.assertEqual(stream.value(), doc)
+
+        f = io.StringIO(json.dumps(doc, indent=2))
+        entries = list(snap_mem.iter_saved_media(f))
+        self.assertEqual(entries, doc["Saved Media"])
+
+    def test_iter_saved_media_empty_and_missing(self):
+        self.assertEqual(list(snap_mem.iter_saved_media(io.StringIO('{"Saved Media": []}'))), [])
+        self.assertEqual(list(snap_mem.iter_saved_media(io.StringIO('{"x": [1, 2]}'))), [])
+        self.assertEqual(list(snap_mem.iter_saved_media(io.StringIO("{}"))), [])
+
+    def test_iter_saved_media_truncated(self):
+        f = io.StringIO('{"Saved Media": [{"Date": "2023-01-01 12:00:00 UTC"}, {"Da')
+        with self.assertRaises(ValueError):
+            list(snap_mem.iter_saved_media(f))
+
+    def test_iter_items_filters_while_streaming(self):
+        doc = {"Saved Media": [
+            {"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Video", "Media Download Url": "https://x/1"},
+            {"Date": "2023-01-01 12:00:01 UTC", "Media Type": "Image", "Media Download Url": "https://x/2"},
+            {"Date": "2023-01-01 12:00:02 UTC", "Media Type": "Image", "Media Download Url": "ftp://x/3"},
+            "junk",
+        ]}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            path.write_text(json.dumps(doc), encoding="utf-8")
+            items = snap_mem.iter_items(path, "image")
+            self.assertEqual(next(items).url, "https://x/2")
+            self.assertEqual(list(items), [])
+            self.assertEqual([i.url for i in snap_mem.iter_items(path, "all")], ["https://x/1", "https://x/2"])
+
+    def test_aimd_increase_and_decrease(self):
+        ctl = snap_mem.AimdController(initial=4, lo=2, hi=6, interval=0.0)
+        ctl.acquire()
+        ctl.release(1000)  # first sample beats the 0 B/s baseline
+        self.assertEqual(ctl.limit, 5)
+        headers = Message()
+        headers["Retry-After"] = "0"
+        ctl.on_error(HTTPError("u", 429, "Too Many", headers, None))
+        self.assertEqual(ctl.limit, 2)
+        ctl.on_error(HTTPError("u", 503, "Unavailable", headers, None))
+        self.assertEqual(ctl.limit, 2)  # clamped at lo
+        ctl.on_error(HTTPError("u", 404, "Not Found", headers, None))
+        self.assertEqual(ctl.limit, 2)
+
+    def test_workers_outside_bounds_is_an_error(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            entry = {"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Image", "Media Download Url": "https://x/1"}
+            path.write_text(json.dumps({"Saved Media": [entry]}), encoding="utf-8")
+            base = ["--no-tui", "--json", str(path), "--out", tmp, "--preflight", "0"]
+            for flags in (["--workers", "32", "--max-workers", "8"], ["--workers", "1", "--min-workers", "2"]):
+                with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                    snap_mem.main([*base, *flags])
+            stats_path = Path(tmp) / "stats.json"
+            with mock.patch.object(snap_mem, "build_opener", lambda: FakeOpener(b"media")), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                rc = snap_mem.main([*base, "--workers", "32", "--stats-json", str(stats_path)])
+            self.assertEqual(rc, 0)
+            self.assertEqual(json.loads(stats_path.read_text())["workers"]["max"], 32)  # default cap raised
+
+    def test_retry_after_and_throttle_classification(self):
+        headers = Message()
+        headers["Retry-After"] = "7"
+        err = HTTPError("u", 429, "Too Many", headers, None)
+        self.assertEqual(snap_mem.retry_after_seconds(err), 7.0)
+        self.assertIsNone(snap_mem.retry_after_seconds(TimeoutError()))
+        self.assertTrue(snap_mem.is_throttle(err))
+        self.assertTrue(snap_mem.is_throttle(URLError(TimeoutError("timed out"))))
+        self.assertFalse(snap_mem.is_throttle(URLError("refused")))
+        self.assertFalse(snap_mem.is_throttle(HTTPError("u", 403, "Forbidden", Message(), None)))
+
+    def test_parse_rate(self):
+        self.assertEqual(snap_mem.parse_rate("0"), 0)
+        self.assertEqual(snap_mem.parse_rate("500K"), 500 * 1024)
+        self.assertEqual(snap_mem.parse_rate("1.5MiB/s"), 1.5 * 1024**2)
+        self.assertEqual(snap_mem.parse_rate("2mb"), 2 * 1024**2)
+        with self.assertRaises(ValueError):
+            snap_mem.parse_rate("fast")
+
+    def test_parse_rate_schedule(self):
+        windows = snap_mem.parse_rate_schedule("08:00-23:00=2M, 23:00-08:00=0")
+        self.assertEqual(windows, [(480, 1380, 2 * 1024**2), (1380, 480, 0.0)])
+        self.assertEqual(snap_mem.parse_rate_schedule(""), [])
+        with self.assertRaises(ValueError):
+            snap_mem.parse_rate_schedule("8-23=2M")
+
+    def test_token_bucket_throttles_across_threads(self):
+        bucket = snap_mem.TokenBucket(20000)
+        start = time.monotonic()
+        threads = [threading.Thread(target=bucket.consume, args=(5000,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 40000 bytes at 20000 B/s with a 20000 B initial burst -> ~1s
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+    def test_token_bucket_schedule_unlimited(self):
+        bucket = snap_mem.TokenBucket(1, schedule=[(0, 0, 0.0)])  # wraps: whole day
+        self.assertEqual(bucket.current_rate(), 0.0)
+        bucket.consume(10**9)  # returns immediately
+
+    def _download(self, tmp, body, mem_limit, headers=None):
+        return snap_mem.download_to_path(
+            opener=FakeOpener(body, headers), url="http://x/", dest=Path(tmp) / "a_memory.zip",
+            timeout=1, user_agent="t", mem_limit=mem_limit,
+        )
+
+    def test_download_payload_memory_and_disk(self):
+        body = b"x" * 5000
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = self._download(tmp, body, mem_limit=10000)
+            self.assertIsNotNone(payload.buf)
+            self.assertEqual(payload.buf.getvalue(), body)
+            self.assertEqual(list(Path(tmp).iterdir()), [])
+
+            payload = self._download(tmp, body, mem_limit=1000)
+            self.assertIsNone(payload.buf)
+            self.assertEqual(payload.path.read_bytes(), body)
+
+            # No Content-Length: starts in memory, spills once past the limit
+            payload = self._download(tmp, body, mem_limit=1000, headers={})
+            self.assertIsNone(payload.buf)
+            self.assertEqual(payload.path.read_bytes(), body)
+            self.assertEqual(payload.size, len(body))
+
+    def test_store_payload_zip_from_memory(self):
+        body = make_zip({"a.jpg": b"jpg", "b.png": b"png", "._a.jpg": b"junk", "notes.txt": b"?"})
+        with tempfile.TemporaryDirectory() as tmp:
+            payload = self._download(tmp, body, mem_limit=1 << 20)
+            names = snap_mem.store_payload(
+                payload, base="b", is_video=False, out_dir=Path(tmp), existing=set(),
+                lock=threading.Lock(),
+            )
+            self.assertEqual(sorted(names), ["b_caption.png", "b_image.jpg"])
+            self.assertEqual(sorted(p.name for p in Path(tmp).iterdir()), sorted(names))
+            self.assertEqual((Path(tmp) / "b_image.jpg").read_bytes(), b"jpg")
+
+            payload = self._download(tmp, b"video", mem_limit=1 << 20)
+            names = snap_mem.store_payload(
+                payload, base="v", is_video=True, out_dir=Path(tmp), existing=set(),
+                lock=threading.Lock(),
+            )
+            self.assertEqual(names, ["v.mp4"])
+            self.assertEqual((Path(tmp) / "v.mp4").read_bytes(), b"video")
+
+    def _task(self, name, size):
+        item = snap_mem.Item(date_str="", url=f"https://x/{name}", is_video=False)
+        return snap_mem.Task(item, name, size)
+
+    def test_task_queue_largest_first(self):
+        q = snap_mem.TaskQueue(maxsize=10, large_size=1 << 30)
+        for name, size in (("a", 10), ("b", 300), ("c", 20), ("d", 300)):
+            q.put(self._task(name, size))
+        q.close()
+        order = []
+        while (task := q.get()) is not None:
+            order.append(task.base)
+            q.done(task)
+        self.assertEqual(order, ["b", "d", "c", "a"])  # ties keep JSON order
+
+    def test_task_queue_json_order(self):
+        q = snap_mem.TaskQueue(maxsize=10, large_size=0, by_size=False)
+        for name, size in (("a", 10), ("b", 300)):
+            q.put(self._task(name, size))
+        q.close()
+        a, b = q.get(), q.get()
+        q.done(a)
+        q.done(b)
+        self.assertEqual([a.base, b.base, q.get()], ["a", "b", None])
+
+    def test_task_queue_caps_large_transfers(self):
+        q = snap_mem.TaskQueue(maxsize=10, large_size=100, max_large=1)
+        for name, size in (("big1", 500), ("big2", 400), ("small", 10)):
+            q.put(self._task(name, size))
+        q.close()
+        first = q.get()
+        self.assertEqual(first.base, "big1")
+        small = q.get()
+        self.assertEqual(small.base, "small")  # big2 waits for the large slot
+        q.done(first)
+        big2 = q.get()
+        self.assertEqual(big2.base, "big2")
+        q.done(small)
+        q.done(big2)
+        self.assertIsNone(q.get())
+
+    def test_task_queue_retry_waits_without_blocking_others(self):
+        q = snap_mem.TaskQueue(maxsize=10, large_size=0, by_size=False)
+        q.put(self._task("a", 10))
+        q.put(self._task("b", 10))
+        q.close()
+        a = q.get()
+        q.retry(a, 0.2)
+        q.done(a)
+        started = time.monotonic()
+        b = q.get()
+        self.assertEqual(b.base, "b")  # not held up by a's delay
+        q.done(b)
+        again = q.get()  # queue is closed but a is still pending
+        self.assertIs(again, a)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        q.done(again)
+        self.assertIsNone(q.get())
+
+    def test_task_queue_cancel_drops_pending(self):
+        q = snap_mem.TaskQueue(maxsize=10, large_size=0)
+        for name in "abc":
+            q.put(self._task(name, 10))
+        a, b = q.get(), q.get()
+        q.retry(b, 60)
+        q.done(b)
+        self.assertEqual(q.cancel(), 2)  # c queued, b delayed
+        q.put(self._task("d", 10))
+        q.retry(a, 0)
+        q.done(a)
+        self.assertIsNone(q.get())
+
+    def test_expired_abort_stops_queued_downloads(self):
+        class SlowOpener:
+            calls = 0
+
+            def open(self, req, timeout=None):
+                SlowOpener.calls += 1
+                time.sleep(0.05)
+                return FakeResponse(b"media")
+
+        entries = [
+            {"Date": f"2023-01-01 12:00:{i:02d} UTC", "Media Type": "Image", "Media Download Url": f"https://x/{i}"}
+            for i in range(40)
+        ]
+        entries.append({"Date": "2023-01-02 12:00:00 UTC", "Media Type": "Image",
+                        "Media Download Url": "https://x/e?Expires=1000000000"})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            path.write_text(json.dumps({"Saved Media": entries}), encoding="utf-8")
+            with mock.patch.object(snap_mem, "build_opener", SlowOpener), \
+                    contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    snap_mem.main([
+                        "--no-tui", "--json", str(path), "--out", tmp, "--preflight", "0",
+                        "--expired", "abort", "--workers", "1", "--max-workers", "1",
+                    ])
+        self.assertLess(SlowOpener.calls, 5)  # only the in-flight download finished
+
+    def test_retry_delay_and_circuit_breaker(self):
+        for attempt in range(4):
+            delay = snap_mem.retry_delay(attempt, 1.0, TimeoutError())
+            self.assertTrue(0 <= delay <= 2**attempt)
+        headers = Message()
+        headers["Retry-After"] = "30"
+        throttled = HTTPError("u", 429, "x", headers, None)
+        self.assertGreaterEqual(snap_mem.retry_delay(0, 1.0, throttled), 30)
+
+        controller = snap_mem.AimdController(initial=2, lo=1, hi=4)
+        breaker = snap_mem.CircuitBreaker(controller, threshold=3, cooldown=0.2)
+        err = HTTPError("u", 503, "x", Message(), None)
+        for exc in (err, err, None, err, TimeoutError(), err):
+            breaker.record(exc)
+        self.assertEqual(breaker.trips, 0)  # success resets; timeouts don't count
+        breaker.record(err)
+        self.assertEqual(breaker.trips, 1)
+        started = time.monotonic()
+        controller.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def test_probe_size_from_content_range(self):
+        opener = FakeOpener(b"x", {"Content-Range": "bytes 0-0/12345"})
+        size = snap_mem.probe_size(opener=opener, url="http://x/", timeout=1, user_agent="t")
+        self.assertEqual(size, 12345)
+
+    def _store(self, tmp, body, base, dedupe, existing):
+        payload = snap_mem.download_to_path(
+            opener=FakeOpener(body), url="http://x/", dest=Path(tmp) / f"{base}_memory.zip",
+            timeout=1, user_agent="t", mem_limit=1 << 20, digest=True,
+        )
+        return snap_mem.store_payload(
+            payload, base=base, is_video=False, out_dir=Path(tmp), existing=existing,
+            lock=threading.Lock(), dedupe=dedupe,
+        )
+
+    def test_dedupe_hardlinks_repeats_across_runs(self):
+        zipped = make_zip({"a.jpg": b"same", "b.png": b"cap"})
+        with tempfile.TemporaryDirectory() as tmp:
+            existing = set()
+            dedupe = snap_mem.DedupeIndex(Path(tmp), "link")
+            self.assertEqual(self._store(tmp, b"same", "one", dedupe, existing), ["one.jpg"])
+            self.assertEqual(self._store(tmp, b"same", "two", dedupe, existing), ["two.jpg"])
+            names = self._store(tmp, zipped, "three", dedupe, existing)
+            self.assertEqual(sorted(names), ["three_caption.png", "three_image.jpg"])
+            one = os.stat(Path(tmp) / "one.jpg")
+            for name in ("two.jpg", "three_image.jpg"):
+                st = os.stat(Path(tmp) / name)
+                self.assertEqual((st.st_dev, st.st_ino), (one.st_dev, one.st_ino))
+            self.assertEqual((dedupe.duplicates, dedupe.saved_bytes), (2, 8))
+
+            # A fresh index reloads the digests persisted by the previous run
+            again = snap_mem.DedupeIndex(Path(tmp), "skip")
+            self.assertEqual(self._store(tmp, b"same", "four", again, existing), [])
+            self.assertFalse((Path(tmp) / "four.jpg").exists())
+            self.assertEqual(again.duplicates, 1)
+
+    def test_output_layout_shards_lazily(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "2023" / "01").mkdir(parents=True)
+            (root / "2023" / "01" / "2023-01-05_10-00-00_image.jpg").write_bytes(b"x")
+            layout = snap_mem.OutputLayout(root, "year/month")
+            shard = layout.shard_for("2023-01-05_10-00-00-dup-1")
+            self.assertEqual(shard, root / "2023" / "01")
+            self.assertIn("2023-01-05_10-00-00", layout.prefixes(shard))
+            other = layout.shard_for("2024-12-31_23-59-59")
+            self.assertFalse(other.exists())
+            self.assertEqual(layout.names(other), set())
+            self.assertTrue(other.is_dir())
+            self.assertEqual(snap_mem.OutputLayout(root, "year").shard_for("2024-12-31_x"), root / "2024")
+            self.assertEqual(snap_mem.OutputLayout(root).shard_for("2024-12-31_x"), root)
+
+    def test_layout_with_disk_spill(self):
+        doc = {"Saved Media": [
+            {"Date": f"2023-0{m}-01 12:00:00 UTC", "Media Type": "Image", "Media Download Url": f"https://x/{m}"}
+            for m in (1, 2)
+        ]}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            path.write_text(json.dumps(doc), encoding="utf-8")
+            out = Path(tmp) / "out"
+            body = make_zip({"a.jpg": b"jpg"})
+            with mock.patch.object(snap_mem, "build_opener", lambda: FakeOpener(body)), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                rc = snap_mem.main([
+                    "--no-tui", "--json", str(path), "--out", str(out), "--preflight", "0",
+                    "--layout", "year/month", "--mem-threshold", "0", "--retries", "0",
+                ])
+            self.assertEqual(rc, 0)
+            for month in ("01", "02"):
+                self.assertEqual(
+                    [p.name for p in (out / "2023" / month).iterdir()], [f"2023-{month}-01_12-00-00_image.jpg"]
+                )
+
+    def test_download_disk_path_with_write_buffer(self):
+        body = os.urandom(3 * 1024 * 1024 + 123)
+        with tempfile.TemporaryDirectory() as tmp:
+            for write_buffer in (0, 4 * 1024 * 1024):
+                for headers in (None, {}):  # with and without Content-Length
+                    payload = snap_mem.download_to_path(
+                        opener=FakeOpener(body, headers), url="http://x/",
+                        dest=Path(tmp) / "v.mp4", timeout=1, user_agent="t",
+                        write_buffer=write_buffer,
+                    )
+                    self.assertEqual(payload.path.read_bytes(), body)
+                    self.assertFalse((Path(tmp) / "v.mp4.part").exists())
+
+    def test_recv_buffer_is_reused_per_thread(self):
+        a = snap_mem.recv_buffer(1024)
+        b = snap_mem.recv_buffer(512)
+        self.assertIs(a.obj, b.obj)
+        self.assertEqual(len(b), 512)
+
+    def test_url_expiry(self):
+        self.assertEqual(snap_mem.url_expiry("https://cdn/x.jpg?Expires=1700000000&Signature=a"), 1700000000)
+        amz = "https://s3/x?X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600&X-Amz-Signature=f"
+        self.assertEqual(snap_mem.url_expiry(amz), 1704067200 + 3600)
+        goog = "https://gcs/x?x-goog-date=20240101T000000Z&x-goog-expires=60"
+        self.assertEqual(snap_mem.url_expiry(goog), 1704067200 + 60)
+        self.assertIsNone(snap_mem.url_expiry("https://app.snapchat.com/dmd/memories?uid=1&sid=2"))
+        self.assertIsNone(snap_mem.url_expiry("https://cdn/x?Expires=soon"))
+
+    def test_permanent_errors_are_not_retried(self):
+        class FailingOpener:
+            def __init__(self, code):
+                self.code, self.calls = code, 0
+
+            def open(self, req, timeout=None):
+                self.calls += 1
+                raise HTTPError(req.full_url, self.code, "err", Message(), None)
+
+        entry = {"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Image", "Media Download Url": "http://x/1"}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            path.write_text(json.dumps({"Saved Media": [entry]}), encoding="utf-8")
+            for code, calls in ((403, 1), (410, 1), (503, 3)):
+                opener = FailingOpener(code)
+                with mock.patch.object(snap_mem, "build_opener", lambda: opener), \
+                        contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    rc = snap_mem.main([
+                        "--no-tui", "--json", str(path), "--out", tmp, "--preflight", "0",
+                        "--retries", "2", "--retry-backoff", "0",
+                    ])
+                self.assertEqual(rc, 2)
+                self.assertEqual(opener.calls, calls)
+
+    def test_main_with_extraction_pool(self):
+        class RoutingOpener:
+            def open(self, req, timeout=None):
+                if "zip" in req.full_url:
+                    return FakeResponse(make_zip({"a.jpg": b"jpg", "b.png": b"png"}))
+                return FakeResponse(b"media")
+
+        doc = {"Saved Media": [
+            {"Date": f"2023-01-01 12:00:0{i} UTC", "Media Type": "Image",
+             "Media Download Url": f"https://x/{'zip' if i % 2 else 'img'}/{i}"}
+            for i in range(6)
+        ]}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "memories_history.json"
+            path.write_text(json.dumps(doc), encoding="utf-8")
+            out = Path(tmp) / "out"
+            for extract_workers in ("0", "2"):
+                with mock.patch.object(snap_mem, "build_opener", RoutingOpener), \
+                        contextlib.redirect_stdout(io.StringIO()):
+                    rc = snap_mem.main([
+                        "--no-tui", "--json", str(path), "--out", str(out / extract_workers),
+                        "--preflight", "0", "--extract-workers", extract_workers,
+                        "--extract-queue", "1", "--stats-json", str(out / "stats.json"),
+                    ])
+                self.assertEqual(rc, 0)
+                self.assertEqual(len(list((out / extract_workers).iterdir())), 9)
+                stats = json.loads((out / "stats.json").read_text())
+                self.assertEqual((stats["ok"], stats["requests"]), (6, 6))
+                self.assertEqual(stats["extract"]["count"], 6)
+
+    def test_histogram_and_run_stats(self):
+        hist = snap_mem.Histogram()
+        for ms in (3, 40, 40, 700, 120000):
+            hist.add(ms)
+        d = hist.to_dict()
+        self.assertEqual(d["count"], 5)
+        self.assertEqual(d["p50_ms"], 50)
+        self.assertEqual(d["p99_ms"], 120000)
+        self.assertEqual(d["buckets_ms"]["50"], 2)
+        self.assertEqual(d["buckets_ms"]["inf"], 1)
+
+        stats = snap_mem.RunStats()
+        stats.record_response(0.01, 0.05, 1000)
+        stats.record_error(HTTPError("u", 503, "x", Message(), None), retried=True)
+        stats.record_error(TimeoutError(), retried=False)
+        report = stats.to_dict(ok=1)
+        self.assertEqual(report["ok"], 1)
+        self.assertEqual(report["bytes"], 1000)
+        self.assertEqual(report["retries"], {"HTTP 503": 1})
+        self.assertEqual(report["failures"], {"TimeoutError": 1})
+        self.assertEqual(report["ttfb"]["count"], 1)
+        json.dumps(report)
+
+    def test_throughput_counted_as_bytes_arrive(self):
+        stats = snap_mem.RunStats()
+        body = b"x" * (3 * snap_mem.CHUNK_SIZE)
+        # One clock read when the download starts, then one per received chunk
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(stats, "second", side_effect=[0, 0, 1, 2]):
+            snap_mem.download_to_path(
+                opener=FakeOpener(body), url="http://x/", dest=Path(tmp) / "v.mp4", timeout=1,
+                user_agent="t", stats=stats,
+            )
+        mib = snap_mem.CHUNK_SIZE / 1e6
+        self.assertEqual(stats.to_dict()["throughput_mb_s"], [round(mib, 3)] * 3)
+        self.assertEqual(stats.to_dict()["bytes"], len(body))
+
+    def test_media_key_ignores_signatures(self):
+        def item(url, date="2023-01-01 12:00:00 UTC"):
+            return snap_mem.Item(date_str=date, url=url, is_video=False)
+
+        a = item("https://app.snapchat.com/dmd/memories?uid=u&sid=s1&mid=M1&ts=1&sig=aa")
+        b = item("https://app.snapchat.com/dmd/memories?uid=u&sid=s2&mid=M1&ts=2&sig=bb")
+        c = item("https://app.snapchat.com/dmd/memories?uid=u&sid=s1&mid=M2&ts=1&sig=aa")
+        self.assertEqual(snap_mem.media_key(a), snap_mem.media_key(b))
+        self.assertNotEqual(snap_mem.media_key(a), snap_mem.media_key(c))
+        d = item("https://cdn/x.jpg?X-Amz-Date=20240101T000000Z&X-Amz-Signature=1&v=2")
+        e = item("https://cdn/x.jpg?X-Amz-Date=20250101T000000Z&X-Amz-Signature=9&v=2")
+        self.assertEqual(snap_mem.media_key(d), snap_mem.media_key(e))
+        self.assertNotEqual(snap_mem.media_key(d), snap_mem.media_key(item(e.url, "2024-01-01 00:00:00 UTC")))
+
+    def test_merged_exports_from_directory(self):
+        def entry(mid, sig):
+            return {"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Image",
+                    "Media Download Url": f"https://x/m?mid={mid}&sig={sig}"}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / "a").mkdir()
+            (root / "b").mkdir()
+            (root / "a" / "memories_history.json").write_text(
+                json.dumps({"Saved Media": [entry(1, "x"), entry(2, "x")]}))
+            (root / "b" / "memories_history.json").write_text(
+                json.dumps({"Saved Media": [entry(2, "y"), entry(3, "y")]}))
+            (root / "b" / "memories_history (1).json").write_text(
+                json.dumps({"Saved Media": [entry(3, "z"), entry(4, "z")]}))
+            (root / "b" / "other.json").write_text("{}")
+            exports = snap_mem.find_exports([root, root / "a" / "memories_history.json"])
+            self.assertEqual(len(exports), 3)
+            for age, export in enumerate(reversed(exports)):
+                os.utime(export, (1e9 - age, 1e9 - age))  # later in sorted order = newer
+            merged = snap_mem.MergedItems(exports, "all")
+            # Without expiry in the URLs, the copy from the newest export wins
+            self.assertEqual([i.url.split("&")[1] for i in merged], ["sig=x", "sig=z", "sig=y", "sig=y"])
+            self.assertEqual(merged.duplicates, 2)
+            self.assertEqual(sorted(i.url.split("&")[0][-1] for i in merged), ["1", "2", "3", "4"])
+
+    def test_merge_prefers_unexpired_link(self):
+        def export(root, name, expires, mids):
+            (root / name).mkdir()
+            entries = [{"Date": "2023-01-01 12:00:00 UTC", "Media Type": "Image",
+                        "Media Download Url": f"https://x/{name}?mid={mid}&Expires={expires}"} for mid in mids]
+            (root / name / "memories_history.json").write_text(json.dumps({"Saved Media": entries}))
+
+        class RoutingOpener:
+            def __init__(self):
+                self.urls = []
+
+            def open(self, req, timeout=None):
+                self.urls.append(req.full_url)
+                if "/old?" in req.full_url:
+                    raise HTTPError(req.full_url, 403, "expired", Message(), None)
+                return FakeResponse(b"media")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            export(root, "old", 1000000000, ["M0", "M1"])  # listed first, long expired
+            export(root, "new", 4000000000, ["M1"])
+            os.utime(root / "old" / "memories_history.json", (1e9, 1e9))
+            exports = snap_mem.find_exports([root])
+            self.assertEqual([p.parent.name for p in exports], ["new", "old"])
+            merged = list(snap_mem.MergedItems(list(reversed(exports)), "all"))
+            self.assertEqual([i.url for i in merged], ["https://x/old?mid=M0&Expires=1000000000",
+                                                      "https://x/new?mid=M1&Expires=4000000000"])
+
+            # The old export's links all fail the pre-flight, but the new one's pass
+            opener = RoutingOpener()
+            stats_path = root / "stats.json"
+            with mock.patch.object(snap_mem, "build_opener", lambda: opener), \
+                    contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                rc = snap_mem.main([
+                    "--no-tui", "--json", str(root / "old"), str(root / "new"), "--out", str(root / "out"),
+                    "--stats-json", str(stats_path),
+                ])
+            self.assertEqual(rc, 0)
+            stats = json.loads(stats_path.read_text())
+            self.assertEqual((stats["ok"], stats["expired"], stats["merged_duplicates"]), (1, 1, 1))
+            self.assertIn("https://x/new?mid=M1&Expires=4000000000", opener.urls)
+
+    def test_dir_listing_loads_in_batches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            for name in ("b.json", "A.txt", ".hidden", "c.txt"):
+                (root / name).write_text("x")
+            (root / "zdir").mkdir()
+            listing = snap_mem.DirListing(root)
+            listing.load(2)
+            self.assertFalse(listing.done)
+            while not listing.done:
+                listing.load(2)
+            self.assertEqual(
+                listing.entries,
+                [("zdir", True), ("A.txt", False), ("b.json", False), ("c.txt", False)],
+            )
+            self.assertTrue(snap_mem.DirListing(root / "missing").done)
+
+    def test_dir_listing_sorts_logarithmically(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            names = [f"f{i:04d}.txt" for i in range(2000)]
+            for name in names:
+                (root / name).touch()
+            listing = snap_mem.DirListing(root)
+            with mock.patch.object(snap_mem, "listing_key", wraps=snap_mem.listing_key) as key:
+                while not listing.done:
+                    listing.load(10)
+            self.assertEqual(listing.entries, [(n, False) for n in names])
+            # Re-sorting on every one of the 200 batches would compute ~200k keys
+            self.assertLess(key.call_count, 6 * len(names))
+
+    def test_fuzzy_filter(self):
+        entries = [("exports", True), ("memories_history.json", False), ("mh.txt", False)]
+        self.assertEqual(snap_mem.fuzzy_filter(entries, ""), entries)
+        self.assertEqual(
+            [n for n, _ in snap_mem.fuzzy_filter(entries, "mh")],
+            ["mh.txt", "memories_history.json"],
+        )
+        self.assertEqual(snap_mem.fuzzy_filter(entries, "HIST"), [entries[1]])
+        self.assertIsNone(snap_mem.fuzzy_score("zz", "memories"))
+
+
+class TestSnapMemStandIn(unittest.TestCase):
+    """End-to-end runs against the local stand-in CDN from bench_snap_mem.py."""
+
+    def test_run_survives_injected_faults(self):
+        faults = bench_snap_mem.Faults(
+            rate_429=0.1, reset_rate=0.05, midbody_reset_rate=0.05, close_rate=0.3, seed=1
+        )
+        with tempfile.TemporaryDirectory() as tmp, \
+                bench_snap_mem.StandIn(faults, image_kb=16, video_kb=64) as server:
+            export = bench_snap_mem.make_export(
+                Path(tmp) / "memories_history.json", server.base_url, 30, seed=2
+            )
+            out = Path(tmp) / "out"
+            rc, _, stats = bench_snap_mem.run_once(
+                export, out, ["--retries", "8", "--retry-backoff", "0.01", "--workers", "4"]
+            )
+            self.assertEqual(rc, 0)
+            self.assertEqual((stats["ok"], stats["failed"]), (30, 0))
+            self.assertGreater(sum(stats["retries"].values()), 0)
+            entries = json.loads(export.read_text())["Saved Media"]
+            first = entries[0]["Media Download Url"]
+            name = snap_mem.build_base_name(entries[0]["Date"])
+            path = first[len(server.base_url):]
+            if "/zip/" not in path:
+                produced = next(out.glob(f"{name}.*"))
+                self.assertEqual(produced.read_bytes(), server.body(path))
+
+    def test_truncated_body_is_an_error(self):
+        faults = bench_snap_mem.Faults(midbody_reset_rate=1.0)
+        with tempfile.TemporaryDirectory() as tmp, \
+                bench_snap_mem.StandIn(faults, image_kb=64) as server:
+            for mem_limit in (0, 1 << 20):
+                with self.assertRaises(http.client.IncompleteRead):
+                    snap_mem.download_to_path(
+                        opener=snap_mem.build_opener(), url=f"{server.base_url}/jpg/1",
+                        dest=Path(tmp) / "x.jpg", timeout=5, user_agent="t", mem_limit=mem_limit,
+                    )
+                self.assertEqual(list(Path(tmp).iterdir()), [])
+
+
 if __name__ == '__main__':
     unittest.main()